@@ -0,0 +1,68 @@
+"""
+Microbenchmark of the ASGI instance table at 1,000 live instances: creating
+an instance that evicts the least recently used one, and the memory
+allocated per instance.
+
+    python bench/asgi_instances.py [webcorn.py]
+
+Runs src/webcorn.py under CPython with tests/stubs standing in for pyodide.
+To compare with the nested dict table and its linear scans:
+
+    git show c2456a4~:src/webcorn.py > /tmp/webcorn_before.py
+    python bench/asgi_instances.py /tmp/webcorn_before.py
+"""
+import asyncio
+import inspect
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'tests' / 'stubs'))
+import stubbed_webcorn
+
+LIVE = 1000
+CREATED = 5000
+
+
+async def application(scope, receive, send):
+    # stays in flight, like a request waiting for a slow upstream
+    await asyncio.Event().wait()
+
+
+async def main(webcorn):
+    webcorn.application = application
+    server = webcorn.AsgiServer(max_app_count=LIVE)
+    scope = {'type': 'http'}
+    # the stream argument came with the streaming ASGI path
+    with_stream = 'stream' in inspect.signature(server.get_or_create_application_instance).parameters
+
+    def create(i):
+        args = (f'instance-{i}', scope, webcorn.RequestBody(b''))
+        server.get_or_create_application_instance(*args, *((False,) if with_stream else ()))
+
+    for i in range(LIVE):
+        create(i)
+    await asyncio.sleep(0)
+    begin = time.perf_counter()
+    for i in range(LIVE, LIVE + CREATED):
+        create(i)
+    elapsed = time.perf_counter() - begin
+    print(f'create + evict at {LIVE} live instances: {elapsed / CREATED * 1e6:.1f} us per instance')
+
+    await asyncio.sleep(0)
+    for instance_id in list(server.instances):
+        server.delete_application_instance(instance_id)
+    await asyncio.sleep(0)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(LIVE):
+        create(2 * CREATED + i)
+    after = tracemalloc.take_snapshot()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    print(f'allocated per instance: {allocated / LIVE:.0f} bytes')
+
+
+if __name__ == '__main__':
+    webcorn = stubbed_webcorn.load(*sys.argv[1:2])
+    asyncio.run(main(webcorn))
@@ -0,0 +1,56 @@
+"""
+Microbenchmark of the Python side of handing a buffered response to the
+page: encode_envelope(binary_envelope: true) against a stand-in for the
+dict path, best of 5 rounds.
+
+    python bench/envelope.py [webcorn.py]
+
+Under CPython to_js is not available, so the dict path is approximated by
+what it costs in pyodide: copying the dict and the body out of the wasm
+heap, and the headers making a round trip through JSON(JSON.stringify in
+worker.js, JSON.parse in server.js). It underestimates the real to_js of a
+nested dict.
+"""
+import json
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'tests' / 'stubs'))
+import stubbed_webcorn
+
+ROUNDS = 5
+NUMBER = 100_000
+
+HEADERS = {
+    'server': 'Webcorn/0.2.7 CPython/3.12.1',
+    'content-type': 'text/html; charset=utf-8',
+    'content-length': '4096',
+    'vary': 'Cookie, Accept-Language',
+    'x-frame-options': 'DENY',
+    'x-content-type-options': 'nosniff',
+    'referrer-policy': 'same-origin',
+    'set-cookie': ['csrftoken=Jx0bS5nTq2cJ7yqA1lF4w8Zk3pV6mR9d; Max-Age=31449600; Path=/'],
+}
+
+
+def dict_path(response):
+    converted = dict(response)
+    converted['headers'] = json.loads(json.dumps(response['headers']))
+    converted['body'] = bytes(response['body'])
+    return converted
+
+
+def best(func, response):
+    return min(timeit.repeat(lambda: func(response), number=NUMBER, repeat=ROUNDS)) / NUMBER * 1e6
+
+
+def main(webcorn):
+    for size in (4 * 1024, 64 * 1024):
+        response = {'status': 200, 'headers': HEADERS, 'body': memoryview(bytes(size))}
+        print(f'{size // 1024} KiB body: encode_envelope {best(webcorn.encode_envelope, response):.2f} us, '
+              f'dict path stand-in {best(dict_path, response):.2f} us')
+
+
+if __name__ == '__main__':
+    main(stubbed_webcorn.load(*sys.argv[1:2]))
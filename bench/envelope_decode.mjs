@@ -0,0 +1,61 @@
+// Microbenchmark of the page side of a buffered response: decodeEnvelope
+// from server.js against the JSON round trip of the headers on the dict
+// path(JSON.stringify in worker.js, JSON.parse in server.js).
+//
+//     node bench/envelope_decode.mjs
+import { readFileSync } from 'node:fs';
+
+// server.js is a browser module, take decodeEnvelope out of its source
+const source = readFileSync(new URL('../src/server.js', import.meta.url), 'utf8');
+const start = source.indexOf('const decodeEnvelope');
+const end = source.indexOf('\n}\n', start) + 2;
+const decodeEnvelope = new Function(`${source.slice(start, end)}; return decodeEnvelope;`)();
+
+const headers = {
+    'server': 'Webcorn/0.2.7 CPython/3.12.1',
+    'content-type': 'text/html; charset=utf-8',
+    'content-length': '4096',
+    'vary': 'Cookie, Accept-Language',
+    'x-frame-options': 'DENY',
+    'x-content-type-options': 'nosniff',
+    'referrer-policy': 'same-origin',
+    'set-cookie': ['csrftoken=Jx0bS5nTq2cJ7yqA1lF4w8Zk3pV6mR9d; Max-Age=31449600; Path=/'],
+};
+
+// same layout as encode_envelope in webcorn.py
+const encode = (status, headers, body) => {
+    const fields = [];
+    for (const [name, value] of Object.entries(headers)) {
+        for (const v of Array.isArray(value) ? value : [value]) {
+            fields.push(name, v);
+        }
+    }
+    const block = new TextEncoder().encode(fields.join('\0'));
+    const buffer = new ArrayBuffer(8 + block.length + body.length);
+    const view = new DataView(buffer);
+    view.setUint16(0, status, true);
+    view.setUint16(2, fields.length / 2, true);
+    view.setUint32(4, block.length, true);
+    new Uint8Array(buffer, 8).set(block);
+    new Uint8Array(buffer, 8 + block.length).set(body);
+    return buffer;
+};
+
+const ROUNDS = 5;
+const NUMBER = 100000;
+
+const best = (func) => {
+    let best = Infinity;
+    for (let round = 0; round < ROUNDS; round++) {
+        const begin = performance.now();
+        for (let i = 0; i < NUMBER; i++) {
+            func();
+        }
+        best = Math.min(best, (performance.now() - begin) / NUMBER * 1000);
+    }
+    return best.toFixed(2);
+};
+
+const envelope = encode(200, headers, new Uint8Array(4096));
+console.log(`decodeEnvelope ${best(() => decodeEnvelope(envelope))} us, ` +
+            `JSON.parse(JSON.stringify(headers)) ${best(() => JSON.parse(JSON.stringify(headers)))} us`);
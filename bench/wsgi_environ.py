@@ -0,0 +1,86 @@
+"""
+Microbenchmark of WsgiServer.build_environ for a Chrome navigation request
+of 20 headers, and of normalize_headers for the response headers of a
+Django view, best of 5 rounds.
+
+    python bench/wsgi_environ.py [webcorn.py]
+
+Runs src/webcorn.py under CPython with tests/stubs standing in for pyodide.
+To compare with the environ built from a dict literal per request:
+
+    git show 9f766a7~:src/webcorn.py > /tmp/webcorn_before.py
+    python bench/wsgi_environ.py /tmp/webcorn_before.py
+"""
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'tests' / 'stubs'))
+import stubbed_webcorn
+
+ROUNDS = 5
+NUMBER = 100_000
+
+REQUEST_HEADERS = {
+    'host': 'localhost:8000',
+    'connection': 'keep-alive',
+    'cache-control': 'max-age=0',
+    'sec-ch-ua': '"Chromium";v="128", "Not;A=Brand";v="24", "Google Chrome";v="128"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"macOS"',
+    'upgrade-insecure-requests': '1',
+    'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 '
+                  '(KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36',
+    'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,'
+              'image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+    'sec-fetch-site': 'same-origin',
+    'sec-fetch-mode': 'navigate',
+    'sec-fetch-user': '?1',
+    'sec-fetch-dest': 'document',
+    'referer': 'http://localhost:8000/articles/',
+    'accept-encoding': 'gzip, deflate, br, zstd',
+    'accept-language': 'en-US,en;q=0.9,zh-CN;q=0.8',
+    'cookie': 'csrftoken=Jx0bS5nTq2cJ7yqA1lF4w8Zk3pV6mR9d; sessionid=1a2b3c4d5e6f7g8h9i0j',
+    'if-none-match': 'W/"5d41402abc4b2a76b9719d911017c592"',
+    'if-modified-since': 'Tue, 15 Oct 2024 08:12:31 GMT',
+    'priority': 'u=0, i',
+}
+
+RESPONSE_HEADERS = [
+    ('Content-Type', 'text/html; charset=utf-8'),
+    ('Content-Length', '5324'),
+    ('Vary', 'Cookie, Accept-Language'),
+    ('X-Frame-Options', 'DENY'),
+    ('X-Content-Type-Options', 'nosniff'),
+    ('Referrer-Policy', 'same-origin'),
+    ('Cross-Origin-Opener-Policy', 'same-origin'),
+    ('Set-Cookie', 'csrftoken=Jx0bS5nTq2cJ7yqA1lF4w8Zk3pV6mR9d; expires=Tue, 14 Oct 2025 '
+                   '08:12:31 GMT; Max-Age=31449600; Path=/; SameSite=Lax'),
+]
+
+
+def best(stmt):
+    return min(timeit.repeat(stmt, number=NUMBER, repeat=ROUNDS)) / NUMBER * 1e6
+
+
+def main(webcorn):
+    server = webcorn.WsgiServer()
+    errors = getattr(server, 'errors', None) or webcorn.ErrorStream()
+    request = {
+        'method': 'GET',
+        'scheme': 'http',
+        'server': 'localhost',
+        'port': '8000',
+        'path': '/articles/3/',
+        'query': 'page=2',
+        'headers': REQUEST_HEADERS,
+        'body': b'',
+    }
+    print(f'build_environ ({len(REQUEST_HEADERS)} headers): '
+          f'{best(lambda: server.build_environ(request, errors)):.2f} us')
+    print(f'normalize_headers ({len(RESPONSE_HEADERS)} headers): '
+          f'{best(lambda: webcorn.normalize_headers(RESPONSE_HEADERS)):.2f} us')
+
+
+if __name__ == '__main__':
+    main(stubbed_webcorn.load(*sys.argv[1:2]))
@@ -1,4 +1,5 @@
 import os
+import sys
 import shutil
 import subprocess
 
@@ -24,13 +25,13 @@ shutil.copy('public/flask.html', '../../docs/playground/project_flask')
 print("copy wagtail.html...")
 shutil.copy('public/wagtail.html', '../../docs/playground/project_wagtail')
 print("generate project_django.zip...")
-shutil.make_archive('../../docs/playground/project_django/project_django', 'zip', 'public', 'project_django')
+subprocess.run([sys.executable, '../../pack.py', 'public/project_django', '-o', '../../docs/playground/project_django'])
 print("generate project_fastapi.zip...")
-shutil.make_archive('../../docs/playground/project_fastapi/project_fastapi', 'zip', 'public', 'project_fastapi')
+subprocess.run([sys.executable, '../../pack.py', 'public/project_fastapi', '-o', '../../docs/playground/project_fastapi'])
 print("generate project_flask.zip...")
-shutil.make_archive('../../docs/playground/project_flask/project_flask', 'zip', 'public', 'project_flask')
+subprocess.run([sys.executable, '../../pack.py', 'public/project_flask', '-o', '../../docs/playground/project_flask'])
 print("generate project_wagtail.zip...")
-shutil.make_archive('../../docs/playground/project_wagtail/project_wagtail', 'zip', 'public', 'project_wagtail')
+subprocess.run([sys.executable, '../../pack.py', 'public/project_wagtail', '-o', '../../docs/playground/project_wagtail'])
 print('run http server...')
 os.chdir('../../docs/playground')
 from http.server import test, SimpleHTTPRequestHandler
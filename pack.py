@@ -0,0 +1,81 @@
+"""
+Packs a python project into the {name}.zip archive that webcorn fetches.
+
+The sources are byte-compiled into __pycache__ directories of the archive,
+so the first import in the browser loads bytecode instead of compiling
+every module inside WebAssembly. The bytecode is hash-checked: unpacking
+the archive changes source mtimes, which would invalidate timestamp based
+bytecode.
+
+Bytecode is only usable by the same python version as pyodide
+(3.12 for pyodide 0.27), other versions fall back to the sources.
+
+With --sync, {name}.manifest.json(path -> sha256/size) and the content
+addressed {name}.objects/ directory are generated as well, for the 'sync'
+option of webcorn which only fetches the files changed since the last start.
+
+    python pack.py PROJECT_DIR [-o OUTPUT_DIR] [--sync]
+"""
+import argparse
+import compileall
+import hashlib
+import json
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+from py_compile import PycInvalidationMode
+
+PYODIDE_PYTHON = (3, 12)
+IGNORE = shutil.ignore_patterns('__pycache__', '*.pyc', '.git', '.venv', 'node_modules')
+
+
+def write_manifest(staging, output, name):
+    objects = output / f'{name}.objects'
+    shutil.rmtree(objects, ignore_errors=True)
+    objects.mkdir(parents=True)
+    files = {}
+    for path in sorted(staging.rglob('*')):
+        if not path.is_file():
+            continue
+        data = path.read_bytes()
+        digest = hashlib.sha256(data).hexdigest()
+        files[path.relative_to(staging).as_posix()] = {'sha256': digest, 'size': len(data)}
+        (objects / digest).write_bytes(data)
+    manifest = output / f'{name}.manifest.json'
+    with manifest.open('w') as f:
+        json.dump({'name': name, 'files': files}, f, indent=1)
+    print(f"wrote {manifest} with {len(files)} files")
+
+
+def pack(project, output, sync=False):
+    project = Path(project).resolve()
+    output = Path(output).resolve()
+    if sys.version_info[:2] != PYODIDE_PYTHON:
+        print(f"warning: python {sys.version_info[0]}.{sys.version_info[1]} bytecode "
+              f"won't be used by pyodide's python {PYODIDE_PYTHON[0]}.{PYODIDE_PYTHON[1]}")
+    with tempfile.TemporaryDirectory() as tmp:
+        staging = Path(tmp) / project.name
+        shutil.copytree(project, staging, ignore=IGNORE)
+        compileall.compile_dir(staging, quiet=1, ddir=project.name,
+                               invalidation_mode=PycInvalidationMode.CHECKED_HASH)
+        output.mkdir(parents=True, exist_ok=True)
+        archive = shutil.make_archive(str(output / project.name), 'zip', tmp, project.name)
+        if sync:
+            write_manifest(staging, output, project.name)
+    print(f"packed {project} into {archive}")
+    return archive
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack a python project for webcorn")
+    parser.add_argument('project', help="project directory")
+    parser.add_argument('-o', '--output', default='.', help="directory of the generated archive")
+    parser.add_argument('--sync', action='store_true',
+                        help="also generate the manifest and objects for incremental sync")
+    args = parser.parse_args()
+    pack(args.project, args.output, args.sync)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,8 @@ const webcornConfig = {
     appSpec: 'app:app',
     appUrl: 'app',
     log: null,
+    // options of the python server, see config in webcorn.py
+    serverOptions: {},
 };
 
 const WORKER_JS = `
@@ -20,6 +22,16 @@ const consoleLog = (msg) => {
     }
 }
 
+// Structured log records {level, logger, time, message, fields} batched by
+// LogSink in webcorn.py, only formatted when there is a log function
+const consoleLogBatch = (records) => {
+    if (webcornConfig.log) {
+        for (const record of records) {
+            webcornConfig.log(record.message);
+        }
+    }
+}
+
 const accessLog = (request, response) => {
     const now = new Date();
     const year = now.getFullYear();
@@ -36,6 +48,28 @@ const accessLog = (request, response) => {
     consoleLog(`${time} "${method} ${path}" ${status}`)
 }
 
+// Decodes the binary envelope made by encode_envelope in webcorn.py: status,
+// headers and body in one buffer, the body stays a view of the buffer
+const decodeEnvelope = (buffer) => {
+    const view = new DataView(buffer);
+    const status = view.getUint16(0, true);
+    const count = view.getUint16(2, true);
+    const blockLength = view.getUint32(4, true);
+    const headers = {};
+    if (count > 0) {
+        const fields = new TextDecoder().decode(new Uint8Array(buffer, 8, blockLength)).split('\0');
+        for (let i = 0; i < count * 2; i += 2) {
+            const name = fields[i];
+            if (name === 'set-cookie') {
+                (headers[name] = headers[name] || []).push(fields[i+1]);
+            } else {
+                headers[name] = fields[i+1];
+            }
+        }
+    }
+    return { status, headers, body: new Uint8Array(buffer, 8 + blockLength) };
+}
+
 class WebcornWorker {
     constructor() {
         const parts = webcornConfig.projectRoot.split('/');
@@ -43,7 +77,7 @@ class WebcornWorker {
     }
 
     getLogger() {
-        return Comlink.proxy({ log: consoleLog });
+        return Comlink.proxy({ log: consoleLog, logBatch: consoleLogBatch });
     }
 
     async start() {
@@ -53,23 +87,51 @@ class WebcornWorker {
                                                webcornConfig.projectRoot,
                                                webcornConfig.appSpec,
                                                webcornConfig.appUrl,
-                                               this.getLogger());
+                                               this.getLogger(),
+                                               webcornConfig.serverOptions);
         this.maxCount = this.isWsgi ? 100 : 1000;
         this.activeCount = 0;
+        this.queued = 0;
     }
 
-    async handleRequest(request) {
+    async stats() {
+        return await this.wrapper.stats();
+    }
+
+    async startupReport() {
+        return await this.wrapper.startupReport();
+    }
+
+    async profiles() {
+        return await this.wrapper.profiles();
+    }
+
+    async cacheStats() {
+        return await this.wrapper.cacheStats();
+    }
+
+    async invalidateCache(path) {
+        return await this.wrapper.invalidateCache(path);
+    }
+
+    prepareRequest(request) {
         // Add cookie header in case the client user agent forgets
         if (document.cookie.length > 0 &&
             !Object.keys(request.headers).some(key => key.toLowerCase() === 'cookie')) {
             request.headers.cookie = document.cookie;
         }
+    }
 
-        Comlink.transfer(request, [request.body]);
-        const response = await this.wrapper.handleRequest(request);
-        Comlink.transfer(response, [response.body]);
-
-        response.headers = JSON.parse(response.headers);
+    receiveResponse(request, response) {
+        this.queued = response.queued || 0;
+        if (response.envelope) {
+            response = decodeEnvelope(response.envelope);
+            // the body is a view of the envelope, transfer the whole buffer
+            Comlink.transfer(response, [response.body.buffer]);
+        } else {
+            Comlink.transfer(response, [response.body]);
+            response.headers = JSON.parse(response.headers);
+        }
 
         accessLog(request, response);
 
@@ -87,8 +149,25 @@ class WebcornWorker {
         return response;
     }
 
+    async handleRequest(request) {
+        this.prepareRequest(request);
+        Comlink.transfer(request, [request.body]);
+        const response = await this.wrapper.handleRequest(request);
+        return this.receiveResponse(request, response);
+    }
+
+    // Sends several requests to the worker in one message, e.g. requests
+    // arriving in the same tick, and returns their responses in order
+    async handleRequestBatch(requests) {
+        requests.forEach((request) => this.prepareRequest(request));
+        Comlink.transfer(requests, requests.map((request) => request.body));
+        const responses = await this.wrapper.handleRequestBatch(requests);
+        return responses.map((response, i) => this.receiveResponse(requests[i], response));
+    }
+
     retain() {
-        if (this.activeCount < this.maxCount) {
+        // A worker queueing requests is saturated, let another worker take them
+        if (this.activeCount < this.maxCount && this.queued === 0) {
             this.activeCount ++;
             return true;
         } else {
@@ -104,6 +183,7 @@ class WebcornWorker {
 }
 
 const workers = [];
+let startingWorker = null;
 
 const retainWorker = async () => {
     let worker;
@@ -118,10 +198,17 @@ const retainWorker = async () => {
     }
     worker = null;
     try {
-        worker = new WebcornWorker();
-        await worker.start();
-        workers.push(worker);
-        worker.retain();
+        // Requests arriving while a worker starts wait for the same worker
+        if (!startingWorker) {
+            startingWorker = (async () => {
+                const newWorker = new WebcornWorker();
+                await newWorker.start();
+                workers.push(newWorker);
+                return newWorker;
+            })().finally(() => { startingWorker = null; });
+        }
+        worker = await startingWorker;
+        worker.activeCount ++;
         return worker;
     } catch (e) {
         consoleLog(e);
@@ -168,11 +255,14 @@ export const startAppServer = (options) => {
         projectRoot = '/',
         appSpec = 'app:app',
         log = null,
+        // 其余选项传给python服务器，如stream(流式返回响应体，需要浏览器支持transferable ReadableStream)
+        ...serverOptions
     } = options || {};
     webcornConfig.pyodideUrl = pyodideUrl;
     webcornConfig.projectRoot = projectRoot;
     webcornConfig.appSpec = appSpec;
     webcornConfig.log = log;
+    webcornConfig.serverOptions = serverOptions;
     webcornConfig.appUrl = new URL('./~webcorn', self.location).href;
 
     const serverUrl = new URL('.', self.location).href;
@@ -155,7 +155,7 @@ const handleFetch = async event => {
                     },
                 });
             }
-        } else if (fileName.endsWith('.zip')) {
+        } else if (fileName.endsWith('.zip') || fileName.endsWith('.manifest.json')) {
             return await networkFirst(event.request);
         }
     }
@@ -1,22 +1,40 @@
 # some of the code from uvicorn
 
-from functools import partial
+from functools import partial, lru_cache
+from contextlib import contextmanager
+from contextvars import ContextVar
 from asyncio import iscoroutinefunction
-from importlib import import_module
+from importlib import import_module, invalidate_caches
+from importlib.machinery import PathFinder
+from importlib.util import cache_from_source
+from py_compile import compile as compile_source, PycInvalidationMode
 from pathlib import Path
-from urllib.parse import urlparse, urljoin
+from urllib.parse import urlparse, urljoin, unquote
 from collections.abc import Iterable
 import traceback
+import hashlib
+import shutil
+import zipfile
+import tomllib
+import json
+import re
+import mimetypes
+import secrets
+import struct
 import asyncio
 import inspect
 import time
 import sys
 import os
-from io import BytesIO
-from pyodide.ffi import to_js
+from io import BytesIO, StringIO
+from collections import deque, OrderedDict
+from bisect import bisect_left
+from pyodide.ffi import to_js, can_run_sync, run_sync, create_once_callable
 from pyodide.http import pyfetch
 from js import Object
 from platform import python_implementation
+from email.parser import HeaderParser
+from email.utils import parsedate_to_datetime, formatdate
 import micropip
 
 version = '0.2.7'
@@ -27,33 +45,243 @@ is_asgi = False
 app_root = ''
 server_version = f'Webcorn/{version} {python_implementation()}/{sys.version.split()[0]}'
 is_django = False
+# pinned packages of the last successful dependency installation
+LOCK_FILE = 'webcorn.lock'
 wsgi_server = None
 asgi_server = None
+request_profiler = None
+response_cache = None
+static_files = None
+single_flight = None
+config = {
+    # return response body chunk by chunk instead of as a single buffer
+    'stream': False,
+    # WSGI response streams left open at once, and seconds a WSGI or ASGI
+    # stream may go unread, before they are closed(readers that never drain
+    # or cancel)
+    'max_streams': 100,
+    'stream_idle_timeout': 60,
+    # ASGI admission control: requests running at once, requests waiting
+    # for a slot, seconds a request may wait, Retry-After of a rejection
+    'max_concurrency': 100,
+    'max_queue': 1000,
+    'queue_timeout': 30,
+    'retry_after': 1,
+    # packages of the pyodide distribution installed on the first import of
+    # one of their modules, see LazyPackageInstaller. Others are left to
+    # requirements, as libraries probe optional modules with try/import.
+    'lazy_packages': ['sqlite3', 'ssl', 'lzma', 'tzdata'],
+    # directory of wheels installed before falling back to the package index,
+    # relative to the project root
+    'wheelhouse': 'wheelhouse',
+    # fetch {project}-wheels.zip next to the project archive into the wheelhouse
+    'wheel_bundle': False,
+    # directory of a persistent(IndexedDB) bytecode cache, e.g. '/webcorn-pycache'
+    'pycache': '',
+    # keep the project root in IndexedDB and only fetch the files changed
+    # since the last start, see {project}.manifest.json generated by pack.py
+    'sync': False,
+    # time the import of each module during startup, see StartupProfiler
+    'profile_imports': True,
+    # per route latency/size histograms served at {appUrl}/~webcorn/metrics
+    'metrics': False,
+    # cProfile requests carrying the profile_header, or 1 in profile_sample
+    # requests(0 for header only), keep the last profile_history summaries
+    # of the profile_top functions by cumulative time
+    'profile': False,
+    'profile_header': 'x-webcorn-profile',
+    'profile_sample': 0,
+    'profile_history': 20,
+    'profile_top': 30,
+    # log records are handed to js in batches of up to log_batch records,
+    # log_flush_ms after the first one or when a request ends; until the
+    # console is attached or while handing them over fails at most
+    # log_buffer records wait, the oldest are dropped
+    'log_batch': 100,
+    'log_flush_ms': 100,
+    'log_buffer': 1000,
+    # hand buffered responses to js as one binary buffer(see encode_envelope)
+    # instead of an object with a JSON stringified headers
+    'binary_envelope': False,
+    # bytes of the in-memory response cache in front of the application,
+    # 0 to disable, see ResponseCache
+    'response_cache': 0,
+    # attach a weak ETag(hash of the body) to buffered responses without a
+    # validator, and answer conditional requests with 304, see ConditionalResponses
+    'etag': False,
+    # serve the files of static roots(django staticfiles, flask static_folder,
+    # starlette StaticFiles mounts) without the application, files up to
+    # static_cache_file bytes are kept in memory, static_cache bytes at most
+    'static_files': False,
+    'static_cache': 8 * 1024 * 1024,
+    'static_cache_file': 256 * 1024,
+    # bytes sent at most for an open ended range(bytes=N-) of a file, e.g.
+    # media elements start with bytes=0-, and continue with further ranges
+    'max_range': 8 * 1024 * 1024,
+    # identical concurrent GET/HEAD requests of an ASGI app share one run of
+    # the application, identical by method, path, query and these headers
+    'coalesce': False,
+    'coalesce_headers': ['accept', 'accept-language', 'authorization', 'cookie'],
+    # run WSGI requests as tasks(run_wsgi_async) that yield to the event loop
+    # every wsgi_slice_ms between body chunks and at checkpoint(), and answer
+    # 504 after wsgi_timeout seconds(0 for no limit)
+    'wsgi_async': False,
+    'wsgi_slice_ms': 10,
+    'wsgi_timeout': 0,
+}
+
+
+class LogSink:
+    """
+    Buffers structured log records and hands them to js_console.logBatch
+    in batches, instead of crossing to js(and to the page) for every line.
+    Messages are formatted when the batch is flushed. Records are kept
+    while there is no console yet or logBatch fails, up to log_buffer.
+    """
+    def __init__(self):
+        self.records = deque()
+        self.dropped = 0
+        self.timer = None
+        self.failed = False
+
+    def emit(self, level, name, msg, args, fields):
+        records = self.records
+        if len(records) >= config['log_buffer']:
+            records.popleft()
+            self.dropped += 1
+        records.append((level, name, time.time(), msg, args, fields))
+        if js_console is None:
+            # flushed by load_app once the console is attached
+            return
+        if len(records) >= config['log_batch'] and not self.failed:
+            self.flush()
+        elif self.timer is None:
+            try:
+                loop = asyncio.get_event_loop()
+            except RuntimeError:
+                return
+            self.timer = loop.call_later(config['log_flush_ms'] / 1000, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.records or js_console is None:
+            return
+        batch = []
+        for level, name, created, msg, args, fields in self.records:
+            if args:
+                try:
+                    msg = msg % args
+                except (TypeError, ValueError):
+                    msg = f'{msg} {args}'
+            record = {'level': level, 'logger': name, 'time': created * 1000, 'message': msg}
+            if fields:
+                record['fields'] = fields
+            batch.append(record)
+        if self.dropped:
+            batch.insert(0, {'level': 'error', 'logger': 'webcorn', 'time': time.time() * 1000,
+                             'message': f'{self.dropped} log records dropped'})
+        try:
+            js_console.logBatch(to_js(batch, dict_converter=Object.fromEntries))
+        except Exception:
+            # kept for the next flush, retried by the timer instead of on
+            # every record
+            self.failed = True
+            return
+        self.failed = False
+        self.records.clear()
+        self.dropped = 0
+
+
+log_sink = LogSink()
+
 
 class Logger:
     def __init__(self, name):
         self.name = name
-    def info(self, msg, *args):
-        if js_console:
-            js_console.log(msg % args)
-    def error(self, msg, *args):
-        if js_console:
-            js_console.log(msg % args)
+    def info(self, msg, *args, **fields):
+        log_sink.emit('info', self.name, msg, args, fields)
+    def error(self, msg, *args, **fields):
+        log_sink.emit('error', self.name, msg, args, fields)
 
 
-class ErrorStream:
-    def __init__(self, console):
-        self.console = console
+logger = Logger('webcorn')
 
+
+class ErrorStream:
     def flush(self):
         pass
 
     def write(self, msg):
-        self.console.log(msg)
+        log_sink.emit('error', 'wsgi.errors', msg.rstrip('\n'), (), None)
 
     def writelines(self, msgs):
         for msg in msgs:
-            self.console.log(msg)
+            self.write(msg)
+
+
+NEWLINE = re.compile(b'\n')
+
+
+class RequestBody:
+    """
+    Request body handed to the application in bounded pieces: as a sequence
+    of 'http.request' messages for ASGI apps and as the wsgi.input stream
+    for WSGI apps. Only the piece being read is copied out of the request
+    buffer.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, body):
+        self.view = memoryview(body).toreadonly()
+        self.pos = 0
+        self.complete = False
+
+    def __len__(self):
+        return len(self.view)
+
+    def read(self, size=-1):
+        start = self.pos
+        end = len(self.view)
+        if size is not None and size >= 0:
+            end = min(start + size, end)
+        self.pos = end
+        return bytes(self.view[start:end])
+
+    def readline(self, size=-1):
+        start = self.pos
+        limit = len(self.view)
+        if size is not None and size >= 0:
+            limit = min(start + size, limit)
+        # re searches the buffer in place, only the line itself is copied
+        match = NEWLINE.search(self.view, start, limit)
+        end = match.end() if match else limit
+        self.pos = end
+        return bytes(self.view[start:end])
+
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if 0 < hint <= total:
+                break
+        return lines
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def next_message(self):
+        body = self.read(self.CHUNK_SIZE)
+        more_body = self.pos < len(self.view)
+        self.complete = not more_body
+        return {'type': 'http.request', 'body': body, 'more_body': more_body}
 
 
 def is_wsgi_app(app):
@@ -88,45 +316,687 @@ def is_asgi_app(app):
     return False
 
 
-async def install_dependencies(root):
-    # Django need sqlite3
-    await micropip.install('sqlite3')
-
-    # FastAPI need ssl
-    await micropip.install('ssl')
-
+def read_requirements(root):
     requirements = root / 'requirements.txt'
     if requirements.is_file():
         with requirements.open('r') as f:
             requirements = f.readlines()
-        requirements = [req.strip() for req in requirements if req.strip() and not req.startswith('#')]
-        for req in requirements:
-            await micropip.install(req)
-        return
+        return [req.strip() for req in requirements if req.strip() and not req.startswith('#')]
     pyproject = root / 'pyproject.toml'
     if pyproject.is_file():
-        await micropip.install('toml')
-        import toml
-        pyproject = toml.load(pyproject)
-        project = pyproject.get('project')
-        if project:
-            deps = project.get('dependencies')
-            if deps:
-                for dep in deps:
-                    await micropip.install(dep)
-        return
-
-
-async def setup(project_root, app_spec, app_url):
+        with pyproject.open('rb') as f:
+            pyproject = tomllib.load(f)
+        project = pyproject.get('project') or {}
+        return list(project.get('dependencies') or [])
+    return []
+
+
+def read_lock(lockfile):
+    if not lockfile.is_file():
+        return None
+    try:
+        with lockfile.open('r') as f:
+            return json.load(f)
+    except ValueError:
+        logger.error("Ignore invalid lock file %s", lockfile)
+        return None
+
+
+def write_lock(lockfile, requirements, installed, resolve_ms):
+    """
+    Saves the packages installed for requirements, pinned to the exact
+    version and wheel url, so later starts can skip the resolution, and
+    returns the lock.
+    """
+    frozen = json.loads(micropip.freeze())['packages']
+    packages = []
+    for name, dist in installed.items():
+        entry = frozen.get(name) or frozen.get(name.lower().replace('_', '-')) or {}
+        packages.append({
+            'name': name,
+            'version': dist.version,
+            'file_name': entry.get('file_name', ''),
+        })
+    lock = {
+        'requirements': requirements,
+        'resolve_ms': round(resolve_ms, 2),
+        'packages': packages,
+    }
+    try:
+        with lockfile.open('w') as f:
+            json.dump(lock, f, indent=2)
+    except OSError as e:
+        logger.error("Failed to write lock file %s: %s", lockfile, e)
+    return lock
+
+
+class Wheelhouse:
+    """
+    Index of a local directory of wheels. Requirements it can satisfy,
+    along with their dependencies, are installed from emfs: urls, only
+    the rest go to the package index.
+
+    packaging is only imported by load() when the directory exists, newer
+    micropip vendors its own, so projects without a wheelhouse don't need it.
+    """
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        # canonical name -> [(version, path)], newest first
+        self.wheels = {}
+
+    async def load(self):
+        if not self.directory.is_dir():
+            return
+        try:
+            import packaging
+        except ImportError:
+            await micropip.install('packaging')
+        self.index()
+
+    def index(self):
+        from packaging.utils import parse_wheel_filename, InvalidWheelFilename
+        from packaging.tags import sys_tags
+        supported = set(sys_tags())
+        for path in self.directory.glob('*.whl'):
+            try:
+                name, version, _, tags = parse_wheel_filename(path.name)
+            except InvalidWheelFilename:
+                continue
+            if supported.isdisjoint(tags):
+                continue
+            self.wheels.setdefault(name, []).append((version, path))
+        for wheels in self.wheels.values():
+            wheels.sort(reverse=True)
+
+    def __len__(self):
+        return len(self.wheels)
+
+    def find(self, req):
+        from packaging.utils import canonicalize_name
+        for version, path in self.wheels.get(canonicalize_name(req.name), []):
+            if req.specifier.contains(version, prereleases=True):
+                return path
+        return None
+
+    def find_pinned(self, name, version):
+        if not self.wheels:
+            return None
+        from packaging.utils import canonicalize_name
+        for wheel_version, path in self.wheels.get(canonicalize_name(name), []):
+            if str(wheel_version) == version:
+                return path
+        return None
+
+    def dependencies(self, path, extras):
+        from packaging.requirements import Requirement
+        with zipfile.ZipFile(path) as whl:
+            for info in whl.namelist():
+                if info.endswith('.dist-info/METADATA'):
+                    metadata = HeaderParser().parsestr(whl.read(info).decode())
+                    break
+            else:
+                return []
+        deps = []
+        for line in metadata.get_all('Requires-Dist') or []:
+            req = Requirement(line)
+            if req.marker is None or any(req.marker.evaluate({'extra': extra})
+                                         for extra in extras or ['']):
+                deps.append(req)
+        return deps
+
+    def split(self, requirements):
+        """
+        Returns the emfs: urls of the local wheels satisfying requirements
+        and their dependencies, and the requirements left to the index.
+        """
+        if not self.wheels:
+            return [], [str(req) for req in requirements]
+        from packaging.requirements import Requirement, InvalidRequirement
+        from packaging.utils import canonicalize_name
+        local = {}
+        remote = []
+        pending = list(requirements)
+        while pending:
+            req = pending.pop(0)
+            try:
+                parsed = req if isinstance(req, Requirement) else Requirement(req)
+            except InvalidRequirement:
+                remote.append(req)
+                continue
+            name = canonicalize_name(parsed.name)
+            if name in local:
+                continue
+            path = self.find(parsed)
+            if path is None:
+                remote.append(str(req))
+                continue
+            local[name] = path
+            pending.extend(self.dependencies(path, parsed.extras))
+        return [f'emfs:{path}' for path in local.values()], remote
+
+
+def locked_requirements(lock, wheelhouse):
+    requirements = []
+    for package in lock['packages']:
+        file_name = package['file_name']
+        path = wheelhouse.find_pinned(package['name'], package['version'])
+        if path is not None:
+            requirements.append(f'emfs:{path}')
+        elif file_name.startswith(('http:', 'https:', 'emfs:')):
+            requirements.append(file_name)
+        else:
+            # packages of the pyodide distribution
+            requirements.append(f"{package['name']}=={package['version']}")
+    return requirements
+
+
+async def install_dependencies(root):
+    """
+    Installs the requirements of the project, and returns the lock they
+    were installed from or pinned into.
+    """
+    requirements = read_requirements(root)
+    if not requirements:
+        return None
+    lockfile = root / LOCK_FILE
+    begin = time.perf_counter()
+    wheelhouse = Wheelhouse(root / config['wheelhouse'])
+    await wheelhouse.load()
+    if wheelhouse:
+        logger.info("Found %d packages in wheelhouse %s", len(wheelhouse), wheelhouse.directory)
+    lock = read_lock(lockfile)
+    if lock and lock.get('requirements') == requirements:
+        try:
+            # Everything is pinned, install the wheels without resolving
+            await micropip.install(locked_requirements(lock, wheelhouse), deps=False)
+            elapsed = (time.perf_counter() - begin) * 1000
+            logger.info("Installed %d locked packages in %.2fms (resolving took %.2fms)",
+                        len(lock['packages']), elapsed, lock.get('resolve_ms', 0))
+            return lock
+        except Exception as e:
+            logger.error("Failed to install packages from %s, resolving again: %s", LOCK_FILE, e)
+    before = set(micropip.list())
+    local, remote = wheelhouse.split(requirements)
+    if local:
+        # The dependencies found in the wheelhouse are part of local already
+        await micropip.install(local, deps=False)
+    if remote:
+        # One transaction resolves the whole requirement set at once
+        await micropip.install(remote)
+    elapsed = (time.perf_counter() - begin) * 1000
+    installed = {name: dist for name, dist in micropip.list().items() if name not in before}
+    lock = write_lock(lockfile, requirements, installed, elapsed)
+    logger.info("Resolved and installed %d packages in %.2fms, pinned into %s",
+                len(installed), elapsed, LOCK_FILE)
+    if config['sync']:
+        # the project root is the IndexedDB mount, keep the lock for the next start
+        await syncfs(False)
+    return lock
+
+
+class LazyPackageInstaller:
+    """
+    Meta path finder of last resort: a top level module that the regular
+    finders can't find, but a package of config['lazy_packages'] provides,
+    is installed on its first import, so the app only pays for what it
+    imports (sqlite3 for Django, ssl for FastAPI...).
+
+    micropip is async. With JSPI the package is installed right inside the
+    import, otherwise the import fails while the package is installed in
+    the background; call_installing_missing retries after it is done.
+    """
+    def __init__(self):
+        # import name -> package name
+        self.catalog = {}
+        self.attempted = set()
+        self.missing = set()
+        self.installing = None
+        # incremented each time packages are installed
+        self.generation = 0
+
+    async def register(self):
+        lazy = set(config['lazy_packages'])
+        if not lazy:
+            return
+        try:
+            from pyodide_js._api import lockfile_packages
+            packages = lockfile_packages.to_py()
+        except Exception as e:
+            # the catalogue is not public api of pyodide
+            logger.error("Failed to read the pyodide lockfile, installing %s up front: %s",
+                         ', '.join(sorted(lazy)), e)
+            await micropip.install(sorted(lazy))
+            return
+        for package in packages.values():
+            if package['name'] not in lazy:
+                continue
+            for name in package.get('imports') or []:
+                self.catalog[name] = package['name']
+        if self not in sys.meta_path:
+            sys.meta_path.append(self)
+
+    def find_spec(self, fullname, path=None, target=None):
+        if path is not None:
+            return None
+        package = self.catalog.get(fullname)
+        if package is None or package in self.attempted:
+            return None
+        self.attempted.add(package)
+        if can_run_sync():
+            logger.info("Installing package %s for module %s", package, fullname)
+            run_sync(micropip.install(package))
+            self.generation += 1
+            invalidate_caches()
+            return PathFinder.find_spec(fullname)
+        logger.info("Module %s is provided by package %s, installing it", fullname, package)
+        self.missing.add(package)
+        if self.installing is None or self.installing.done():
+            self.installing = asyncio.ensure_future(self.install_missing())
+        return None
+
+    async def install_missing(self):
+        while self.missing:
+            packages = sorted(self.missing)
+            self.missing.clear()
+            try:
+                await micropip.install(packages)
+            except Exception as e:
+                logger.error("Failed to install %s: %s", ', '.join(packages), e)
+                continue
+            self.generation += 1
+            invalidate_caches()
+
+    async def wait(self):
+        if self.installing is not None:
+            await self.installing
+
+
+lazy_installer = LazyPackageInstaller()
+
+
+async def call_installing_missing(func, *args):
+    """
+    Calls func, calling it again as long as packages for the modules it
+    failed to import got installed in the meantime.
+    """
+    while True:
+        generation = lazy_installer.generation
+        try:
+            return func(*args)
+        except Exception:
+            await lazy_installer.wait()
+            if lazy_installer.generation == generation:
+                raise
+
+
+def syncfs(populate):
+    """
+    Loads the persistent mounts from IndexedDB(populate) or saves them.
+    """
+    from pyodide_js import FS
+    future = asyncio.get_running_loop().create_future()
+    def done(error):
+        if error:
+            future.set_exception(OSError(f'syncfs failed: {error}'))
+        else:
+            future.set_result(None)
+    FS.syncfs(populate, create_once_callable(done))
+    return future
+
+
+async def mount_persistent(directory):
+    from pyodide_js import FS
+    FS.mkdirTree(str(directory))
+    FS.mount(FS.filesystems.IDBFS, to_js({}), str(directory))
+    await syncfs(True)
+
+
+class ProjectSync:
+    """
+    Keeps the project root in sync with the manifest(path -> sha256/size)
+    published next to the project archive by pack.py --sync. Only files whose
+    hash changed since the last sync are fetched, from the content addressed
+    {project}.objects/ directory, and each is verified before it is written.
+    """
+    STATE_FILE = '.webcorn-manifest.json'
+    CONCURRENCY = 8
+
+    def __init__(self, path, app_url):
+        self.path = Path(path)
+        self.manifest_url = urljoin(app_url, f'{self.path.name}.manifest.json')
+        self.objects_url = urljoin(app_url, f'{self.path.name}.objects/')
+        self.zip_url = urljoin(app_url, f'{self.path.name}.zip')
+
+    def read_state(self):
+        try:
+            with (self.path / self.STATE_FILE).open('r') as f:
+                return json.load(f)['files']
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def scan(self, files):
+        """
+        Returns the entries of files already on disk with the right content.
+        """
+        present = {}
+        for relpath, entry in files.items():
+            try:
+                data = (self.path / relpath).read_bytes()
+            except OSError:
+                continue
+            if len(data) == entry['size'] and hashlib.sha256(data).hexdigest() == entry['sha256']:
+                present[relpath] = entry
+        return present
+
+    def write_state(self, files):
+        with (self.path / self.STATE_FILE).open('w') as f:
+            json.dump({'files': files}, f)
+
+    async def fetch_object(self, relpath, entry, semaphore):
+        async with semaphore:
+            response = await pyfetch(urljoin(self.objects_url, entry['sha256']))
+            if not response.ok:
+                raise OSError(f'Failed to fetch {relpath}: {response.status}')
+            data = await response.bytes()
+        if len(data) != entry['size'] or hashlib.sha256(data).hexdigest() != entry['sha256']:
+            raise OSError(f'Integrity check failed for {relpath}')
+        target = self.path / relpath
+        target.parent.mkdir(parents=True, exist_ok=True)
+        partial_target = target.with_name(target.name + '.webcorn-partial')
+        partial_target.write_bytes(data)
+        partial_target.replace(target)
+
+    async def sync(self):
+        begin = time.perf_counter()
+        await mount_persistent(self.path)
+        try:
+            response = await pyfetch(self.manifest_url)
+            error = None if response.ok else response.status
+        except Exception as e:
+            # offline, the network failure is raised instead of a status
+            error = e
+        if error is not None:
+            if self.read_state():
+                logger.error("No manifest at %s (%s), using the local project",
+                             self.manifest_url, error)
+                return
+            raise OSError(f'Failed to fetch {self.manifest_url}: {error}')
+        files = (await response.json())['files']
+        local = self.read_state()
+        unpacked = 0
+        if not local:
+            # First start: one archive is cheaper than fetching every file,
+            # the files failing verification are fetched one by one below
+            response = await pyfetch(self.zip_url)
+            await response.unpack_archive(extract_dir=self.path.parent)
+            local = self.scan(files)
+            unpacked = len(local)
+        changed = [p for p, entry in files.items()
+                   if local.get(p) != entry or not (self.path / p).is_file()]
+        removed = [p for p in local if p not in files]
+        semaphore = asyncio.Semaphore(self.CONCURRENCY)
+        await asyncio.gather(*[self.fetch_object(p, files[p], semaphore) for p in changed])
+        for p in removed:
+            try:
+                (self.path / p).unlink()
+            except OSError:
+                pass
+        self.write_state(files)
+        await syncfs(False)
+        logger.info("Synced project %s in %.2fms: %d unpacked, %d fetched, %d removed, %d unchanged",
+                    self.path.name, (time.perf_counter() - begin) * 1000, unpacked,
+                    len(changed), len(removed), len(files) - len(changed) - unpacked)
+
+
+class BytecodeCache:
+    """
+    Bytecode cache kept across page loads: sys.pycache_prefix points into an
+    IndexedDB backed mount. Sources get a new mtime each time the project
+    archive or a wheel is unpacked, so the bytecode of imported modules is
+    rewritten hash-checked to stay valid on the next start.
+    """
+    STATS_FILE = 'webcorn-pycache.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.enabled = False
+        # average milliseconds to compile a module, measured by persist()
+        self.compile_ms = 0.0
+
+    async def enable(self):
+        try:
+            await mount_persistent(self.directory)
+        except Exception as e:
+            logger.error("Bytecode cache %s is not available: %s", self.directory, e)
+            return
+        sys.pycache_prefix = self.directory
+        self.enabled = True
+        try:
+            with open(os.path.join(self.directory, self.STATS_FILE)) as f:
+                self.compile_ms = json.load(f)['compile_ms']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def seed(self, root):
+        """
+        The bytecode bundled in the project archive(see pack.py) is in
+        __pycache__ directories, which are ignored once pycache_prefix is
+        set: copy it under the prefix. Only the bytecode of this interpreter
+        is copied, another version's would be rejected on import anyway.
+        """
+        suffix = f'.{sys.implementation.cache_tag}.pyc'
+        for pyc in Path(root).glob(f'**/__pycache__/*{suffix}'):
+            source = pyc.parent.parent / f'{pyc.name.removesuffix(suffix)}.py'
+            if not source.is_file():
+                continue
+            target = Path(cache_from_source(str(source)))
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(pyc, target)
+
+    async def persist(self):
+        begin = time.perf_counter()
+        count = 0
+        for module in list(sys.modules.values()):
+            source = getattr(module, '__file__', None)
+            cached = getattr(module, '__cached__', None)
+            if not source or not cached or not source.endswith('.py'):
+                continue
+            if not cached.startswith(self.directory):
+                continue
+            try:
+                with open(cached, 'rb') as f:
+                    flags = int.from_bytes(f.read(8)[4:8], 'little')
+            except OSError:
+                flags = 0
+            if flags != 0:
+                # already hash based
+                continue
+            try:
+                compile_source(source, cfile=cached, doraise=True,
+                               invalidation_mode=PycInvalidationMode.CHECKED_HASH)
+                count += 1
+            except Exception:
+                pass
+        if count:
+            self.compile_ms = (time.perf_counter() - begin) * 1000 / count
+            with open(os.path.join(self.directory, self.STATS_FILE), 'w') as f:
+                json.dump({'compile_ms': self.compile_ms}, f)
+        try:
+            await syncfs(False)
+        except Exception as e:
+            logger.error("Failed to persist bytecode cache: %s", e)
+        logger.info("Bytecode cache: wrote %d modules", count)
+
+
+bytecode_cache = None
+
+
+class TimedFinder:
+    """
+    Wraps a meta path finder for StartupProfiler, timing the modules of the
+    specs it finds. A miss costs nothing more than the finder itself.
+    """
+    __slots__ = ('finder', 'profiler')
+
+    def __init__(self, finder, profiler):
+        self.finder = finder
+        self.profiler = profiler
+
+    def find_spec(self, fullname, path=None, target=None):
+        spec = self.finder.find_spec(fullname, path, target)
+        if spec is not None:
+            self.profiler.time_loader(fullname, spec.loader)
+        return spec
+
+    def __getattr__(self, name):
+        # invalidate_caches and the like
+        return getattr(self.finder, name)
+
+
+class StartupProfiler:
+    """
+    Times the phases of load_app, and by wrapping the meta path finders the
+    execution of every module imported meanwhile, like -X importtime:
+    a tree of modules with their self and cumulative milliseconds.
+    """
+    def __init__(self):
+        self.begin = time.perf_counter()
+        self.phases = []
+        # root import nodes: {'module', 'self_ms', 'cumulative_ms', 'children'}
+        self.imports = []
+        self.stack = []
+        self.extra = {}
+
+    @contextmanager
+    def phase(self, name):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append({'name': name, 'ms': (time.perf_counter() - begin) * 1000})
+
+    def hook_imports(self):
+        sys.meta_path[:] = [TimedFinder(finder, self) if hasattr(finder, 'find_spec') else finder
+                            for finder in sys.meta_path]
+
+    def unhook_imports(self):
+        sys.meta_path[:] = [finder.finder if isinstance(finder, TimedFinder) and finder.profiler is self
+                            else finder for finder in sys.meta_path]
+
+    def time_loader(self, fullname, loader):
+        if loader is not None and not isinstance(loader, type) and hasattr(loader, '__dict__') \
+                and 'exec_module' not in loader.__dict__:
+            self.time_exec_module(fullname, loader)
+
+    def time_exec_module(self, fullname, loader):
+        exec_module = loader.exec_module
+        def timed_exec_module(module):
+            del loader.exec_module
+            node = {'module': fullname, 'self_ms': 0.0, 'cumulative_ms': 0.0, 'children': []}
+            (self.stack[-1]['children'] if self.stack else self.imports).append(node)
+            self.stack.append(node)
+            begin = time.perf_counter()
+            try:
+                exec_module(module)
+            finally:
+                self.stack.pop()
+                node['cumulative_ms'] = (time.perf_counter() - begin) * 1000
+                node['self_ms'] = node['cumulative_ms'] - sum(c['cumulative_ms'] for c in node['children'])
+        loader.exec_module = timed_exec_module
+
+    def report(self):
+        return {
+            'total_ms': (time.perf_counter() - self.begin) * 1000,
+            'phases': self.phases,
+            'imports': self.imports,
+            **self.extra,
+        }
+
+    def log_summary(self):
+        phases = ', '.join(f"{phase['name']} {phase['ms']:.2f}ms" for phase in self.phases)
+        logger.info("Started in %.2fms: %s", (time.perf_counter() - self.begin) * 1000, phases)
+        slowest = sorted(self.imports, key=lambda node: node['cumulative_ms'], reverse=True)[:5]
+        if slowest:
+            logger.info("Slowest imports: %s", ', '.join(
+                f"{node['module']} {node['cumulative_ms']:.2f}ms" for node in slowest))
+
+
+def bytecode_report(modules_before, since):
+    """
+    Counts the modules imported since `since` that were loaded from
+    bytecode and those compiled from source.
+    """
+    loaded = compiled = 0
+    for name, module in list(sys.modules.items()):
+        if name in modules_before:
+            continue
+        source = getattr(module, '__file__', None)
+        cached = getattr(module, '__cached__', None)
+        if not source or not cached or not source.endswith('.py'):
+            continue
+        try:
+            mtime = os.stat(cached).st_mtime
+        except OSError:
+            compiled += 1
+            continue
+        if mtime < since:
+            loaded += 1
+        else:
+            compiled += 1
+    return loaded, compiled
+
+
+async def fetch_wheel_bundle(url, wheelhouse):
+    """
+    Unpacks the wheel bundle at url into the wheelhouse directory, returns
+    whether there was one.
+    """
+    response = await pyfetch(url)
+    if not response.ok:
+        logger.info("No wheel bundle at %s (%s)", url, response.status)
+        return False
+    await response.unpack_archive(extract_dir=wheelhouse, format='zip')
+    return True
+
+
+async def setup(project_root, app_spec, app_url, profiler):
     global app_root
     path = Path(project_root)
-    if not path.is_dir():
-        zipurl = urljoin(app_url, f'{path.name}.zip')
-        response = await pyfetch(zipurl)
-        await response.unpack_archive(extract_dir=path.parent)
+    with profiler.phase('fetch_project'):
+        bundle_url = urljoin(app_url, f'{path.name}-wheels.zip')
+        wheelhouse = path / config['wheelhouse']
+        if config['sync']:
+            await ProjectSync(path, app_url).sync()
+            # the wheelhouse is kept in IndexedDB with the project, the bundle
+            # is only fetched once, ship changing wheels in the project instead
+            if config['wheel_bundle'] and not any(wheelhouse.glob('*.whl')):
+                try:
+                    if await fetch_wheel_bundle(bundle_url, wheelhouse):
+                        await syncfs(False)
+                except Exception as e:
+                    logger.error("Failed to fetch wheel bundle %s: %s", bundle_url, e)
+        elif not path.is_dir():
+            zipurl = urljoin(app_url, f'{path.name}.zip')
+            response = await pyfetch(zipurl)
+            await response.unpack_archive(extract_dir=path.parent)
+            if config['wheel_bundle']:
+                await fetch_wheel_bundle(bundle_url, wheelhouse)
     os.chdir(project_root)
 
-    await install_dependencies(path)
+    global bytecode_cache
+    if config['pycache']:
+        with profiler.phase('bytecode_cache'):
+            bytecode_cache = BytecodeCache(config['pycache'])
+            await bytecode_cache.enable()
+            if bytecode_cache.enabled:
+                bytecode_cache.seed(path)
+
+    with profiler.phase('install_dependencies'):
+        lock = await install_dependencies(path)
+    if lock is not None:
+        # the project root is re-unpacked on each page load(unless synced),
+        # the page gets the lock from startupReport() to ship it
+        profiler.extra['lock'] = lock
 
     app_url = urlparse(app_url)
     app_root = app_url.path
@@ -150,10 +1020,1013 @@ async def setup(project_root, app_spec, app_url):
     return syspaths
 
 
+class RequestSample:
+    """
+    perf_counter marks of one request: begin, environ/scope built,
+    application returned(WSGI) or response started(ASGI), body assembled.
+    """
+    __slots__ = ('begin', 'built', 'called', 'finished', 'route')
+
+    def __init__(self):
+        self.begin = time.perf_counter()
+        self.built = self.called = self.finished = None
+        self.route = None
+
+
+class RouteStats:
+    __slots__ = ('count', 'statuses', 'durations', 'duration_sums', 'sizes', 'size_sum')
+
+    def __init__(self):
+        self.count = 0
+        self.statuses = {}
+        self.durations = [[0] * (len(Metrics.DURATION_BUCKETS) + 1) for _ in Metrics.PHASES]
+        self.duration_sums = [0.0] * len(Metrics.PHASES)
+        self.sizes = [0] * (len(Metrics.SIZE_BUCKETS) + 1)
+        self.size_sum = 0
+
+
+class Metrics:
+    """
+    Fixed bucket histograms of request phases and response sizes per route
+    template, rendered as Prometheus text or JSON under METRICS_PATH.
+    """
+    METRICS_PATH = '/~webcorn/metrics'
+    PHASES = ('build', 'app', 'body', 'to_js', 'total')
+    # seconds
+    DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+    # bytes
+    SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+    # routes beyond the limit are counted as OTHER_ROUTE
+    MAX_ROUTES = 500
+    OTHER_ROUTE = '{other}'
+
+    def __init__(self):
+        self.routes = {}
+
+    def start(self):
+        return RequestSample() if config['metrics'] else None
+
+    def is_metrics_request(self, request):
+        # exactly below the app root, the app's own /metrics ends the same
+        return config['metrics'] and request['path'] == app_root.rstrip('/') + self.METRICS_PATH
+
+    def route_stats(self, route):
+        stats = self.routes.get(route)
+        if stats is None:
+            if len(self.routes) >= self.MAX_ROUTES:
+                route = self.OTHER_ROUTE
+                stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = RouteStats()
+        return stats
+
+    def convert(self, response, sample):
+        """
+        Converts the response to js, and records the sample when there is one.
+        """
+        if sample is None:
+            return convert_response(response)
+        converting = time.perf_counter()
+        result = convert_response(response)
+        end = time.perf_counter()
+        begin = sample.begin
+        built = sample.built or converting
+        called = sample.called or built
+        finished = sample.finished or called
+        route = sample.route or self.OTHER_ROUTE
+        stats = self.routes.get(route) or self.route_stats(route)
+        stats.count += 1
+        status = response['status']
+        statuses = stats.statuses
+        statuses[status] = statuses.get(status, 0) + 1
+        buckets = self.DURATION_BUCKETS
+        histograms = stats.durations
+        sums = stats.duration_sums
+        for i, seconds in enumerate((built - begin, called - built, finished - called,
+                                     end - finished, end - begin)):
+            histograms[i][bisect_left(buckets, seconds)] += 1
+            sums[i] += seconds
+        body = response['body']
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            size = len(body)
+            stats.sizes[bisect_left(self.SIZE_BUCKETS, size)] += 1
+            stats.size_sum += size
+        return result
+
+    def to_json(self):
+        routes = {}
+        for route, stats in self.routes.items():
+            routes[route] = {
+                'count': stats.count,
+                'statuses': {str(status): count for status, count in stats.statuses.items()},
+                'phases': {
+                    phase: {'buckets': stats.durations[i], 'sum_seconds': stats.duration_sums[i]}
+                    for i, phase in enumerate(self.PHASES)
+                },
+                'size': {'buckets': stats.sizes, 'sum': stats.size_sum},
+            }
+        return {
+            'duration_buckets_seconds': list(self.DURATION_BUCKETS),
+            'size_buckets': list(self.SIZE_BUCKETS),
+            'routes': routes,
+        }
+
+    def to_prometheus(self):
+        lines = [
+            '# HELP webcorn_request_phase_seconds Time spent in each phase of a request.',
+            '# TYPE webcorn_request_phase_seconds histogram',
+        ]
+        for route, stats in self.routes.items():
+            label = prometheus_label(route)
+            for i, phase in enumerate(self.PHASES):
+                labels = f'route="{label}",phase="{phase}"'
+                cumulative = 0
+                for bound, count in zip(self.DURATION_BUCKETS, stats.durations[i]):
+                    cumulative += count
+                    lines.append(f'webcorn_request_phase_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'webcorn_request_phase_seconds_bucket{{{labels},le="+Inf"}} {stats.count}')
+                lines.append(f'webcorn_request_phase_seconds_sum{{{labels}}} {stats.duration_sums[i]}')
+                lines.append(f'webcorn_request_phase_seconds_count{{{labels}}} {stats.count}')
+        lines += [
+            '# HELP webcorn_response_size_bytes Size of buffered response bodies.',
+            '# TYPE webcorn_response_size_bytes histogram',
+        ]
+        for route, stats in self.routes.items():
+            label = prometheus_label(route)
+            cumulative = 0
+            for bound, count in zip(self.SIZE_BUCKETS, stats.sizes):
+                cumulative += count
+                lines.append(f'webcorn_response_size_bytes_bucket{{route="{label}",le="{bound}"}} {cumulative}')
+            cumulative += stats.sizes[-1]
+            lines.append(f'webcorn_response_size_bytes_bucket{{route="{label}",le="+Inf"}} {cumulative}')
+            lines.append(f'webcorn_response_size_bytes_sum{{route="{label}"}} {stats.size_sum}')
+            lines.append(f'webcorn_response_size_bytes_count{{route="{label}"}} {cumulative}')
+        lines += [
+            '# HELP webcorn_responses_total Responses by status code.',
+            '# TYPE webcorn_responses_total counter',
+        ]
+        for route, stats in self.routes.items():
+            label = prometheus_label(route)
+            for status, count in stats.statuses.items():
+                lines.append(f'webcorn_responses_total{{route="{label}",status="{status}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def response(self, request):
+        """
+        Renders the metrics, as JSON when asked by ?format=json or the
+        Accept header, otherwise in the Prometheus text format.
+        """
+        accept = request['headers'].get('accept', '')
+        if 'format=json' in request['query'] or 'application/json' in accept:
+            body = json.dumps(self.to_json()).encode()
+            content_type = 'application/json'
+        else:
+            body = self.to_prometheus().encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        return {
+            'status': 200,
+            'headers': {
+                'server': server_version,
+                'content-type': content_type,
+                'cache-control': 'no-store',
+            },
+            'body': body,
+        }
+
+
+def prometheus_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def route_template(path, scope):
+    """
+    Route template of a request: the route the framework matched when it
+    tells(FastAPI scope['route'], flask url_rule), otherwise the path with
+    numeric, uuid and hex segments replaced by {id}.
+    """
+    route = scope.get('route')
+    if route is None:
+        request = scope.get('werkzeug.request')
+        route = getattr(request, 'url_rule', None)
+    if route is not None:
+        template = getattr(route, 'path_format', None) or getattr(route, 'rule', None) \
+            or getattr(route, 'path', None)
+        if isinstance(template, str):
+            return template
+    return path_template(path)
+
+
+@lru_cache(maxsize=4096)
+def path_template(path):
+    segments = path.split('/')
+    for i, segment in enumerate(segments):
+        if segment and (segment.isdigit() or is_identifier_segment(segment)):
+            segments[i] = '{id}'
+    return '/'.join(segments)
+
+
+HEX_DIGITS = frozenset('0123456789abcdefABCDEF-')
+
+
+def is_identifier_segment(segment):
+    # uuids and long hex strings, e.g. hashes
+    return len(segment) >= 16 and any(c.isdigit() for c in segment) \
+        and HEX_DIGITS.issuperset(segment)
+
+
+metrics = Metrics()
+
+
+def encode_envelope(response):
+    """
+    Packs a buffered response into a single buffer, little endian: status(u16),
+    header count(u16), length(u32) of the header block, the header block, then
+    the body up to the end. The header block is the utf-8 of names and values
+    joined by NUL, which can't appear in a header, so that it's decoded at
+    once. Each set-cookie is a header of its own. See decodeEnvelope in server.js.
+    """
+    fields = []
+    for name, value in response['headers'].items():
+        if isinstance(value, list):
+            for v in value:
+                fields += (name, v)
+        else:
+            fields += (name, value)
+    block = '\0'.join(fields).encode()
+    head = struct.pack('<HHI', response['status'], len(fields) // 2, len(block))
+    return b''.join((head, block, response['body']))
+
+
+def convert_response(response):
+    if config['binary_envelope'] and isinstance(response['body'], (bytes, bytearray, memoryview)):
+        return to_js(encode_envelope(response))
+    return to_js(response, dict_converter=Object.fromEntries)
+
+
+class RequestProfiler:
+    """
+    Profiles the handling of selected requests with cProfile and keeps the
+    pstats summaries in a ring buffer, see profiles(). For ASGI the profile
+    also covers other tasks running while the request awaits. One request is
+    profiled at a time, cProfile(3.12) refuses a second active profiler.
+    """
+    def __init__(self, header, sample, history, top):
+        import cProfile
+        import pstats
+        self.cProfile = cProfile
+        self.pstats = pstats
+        self.header = header.lower()
+        self.sample = sample
+        self.top = top
+        self.count = 0
+        self.next_id = 1
+        self.history = deque(maxlen=history)
+        self.active = False
+
+    def wants(self, request):
+        if self.active:
+            return False
+        if self.header in request['headers']:
+            return True
+        if self.sample:
+            self.count += 1
+            return self.count % self.sample == 0
+        return False
+
+    def run(self, handle, request, **kwargs):
+        profile = self.cProfile.Profile()
+        begin = time.perf_counter()
+        self.active = True
+        profile.enable()
+        try:
+            response = handle(request, **kwargs)
+        finally:
+            profile.disable()
+            self.active = False
+        return self.record(profile, request, response, begin)
+
+    async def run_async(self, handle, request, **kwargs):
+        profile = self.cProfile.Profile()
+        begin = time.perf_counter()
+        self.active = True
+        profile.enable()
+        try:
+            response = await handle(request, **kwargs)
+        finally:
+            profile.disable()
+            self.active = False
+        return self.record(profile, request, response, begin)
+
+    def record(self, profile, request, response, begin):
+        elapsed = (time.perf_counter() - begin) * 1000
+        output = StringIO()
+        stats = self.pstats.Stats(profile, stream=output)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        profile_id = self.next_id
+        self.next_id += 1
+        self.history.append({
+            'id': profile_id,
+            'time': time.time(),
+            'method': request['method'],
+            'path': request['path'],
+            'query': request['query'],
+            'status': response['status'],
+            'ms': elapsed,
+            'calls': stats.total_calls,
+            'summary': output.getvalue(),
+        })
+        response['headers']['x-webcorn-profile-id'] = str(profile_id)
+        logger.info("Profiled %s %s in %.2fms, profile id %s",
+                    request['method'], request['path'], elapsed, profile_id)
+        return response
+
+
+def parse_cache_control(value):
+    """
+    Parses a Cache-Control header into {directive: argument or None}.
+    """
+    directives = {}
+    for part in value.split(','):
+        name, _, argument = part.partition('=')
+        name = name.strip().lower()
+        if name:
+            directives[name] = argument.strip().strip('"') or None
+    return directives
+
+
+def cache_seconds(directives, name):
+    try:
+        return int(directives.get(name) or '')
+    except ValueError:
+        return None
+
+
+class CachedResponse:
+    __slots__ = ('status', 'headers', 'body', 'size', 'stored', 'expires', 'age', 'path')
+
+    def __init__(self, response, size, now, max_age, age, path):
+        self.status = response['status']
+        self.headers = response['headers']
+        self.body = response['body']
+        self.size = size
+        self.stored = now
+        self.expires = now + max_age
+        self.age = age
+        self.path = path
+
+
+class ResponseCache:
+    """
+    Shared HTTP cache in front of the application for GET and HEAD requests.
+    Keyed on method, path, query and the headers named by Vary. Only
+    responses with Cache-Control max-age or s-maxage are stored, and
+    no-store, no-cache, private, set-cookie and Vary: * are not, nor the
+    responses to requests with Authorization unless public, s-maxage or
+    must-revalidate allow it(RFC 9111 3.5). Entries
+    live in a LRU bounded by bytes and expire with their max-age.
+    Successful unsafe requests invalidate the entries of their path.
+    """
+    CACHEABLE_METHODS = frozenset(('GET', 'HEAD'))
+    SAFE_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'TRACE'))
+    CACHEABLE_STATUS = frozenset((200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501))
+    # rough bytes of an entry besides the body and headers
+    ENTRY_OVERHEAD = 256
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        # (method, path, query) -> lowercase header names of the last Vary,
+        # and the number of its entries, both dropped with the last entry
+        self.vary = {}
+        self.variants = {}
+        # path -> keys of its entries, for invalidation
+        self.paths = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def key(self, request, vary):
+        headers = request['headers']
+        return (request['method'], request['path'], request['query'],
+                *(headers.get(name, '') for name in vary))
+
+    def lookup(self, request):
+        """
+        Returns the cached response of the request, or None.
+        """
+        method = request['method']
+        if method not in self.CACHEABLE_METHODS:
+            return None
+        cache_control = request['headers'].get('cache-control')
+        if cache_control:
+            directives = parse_cache_control(cache_control)
+            if 'no-cache' in directives or 'no-store' in directives \
+                    or cache_seconds(directives, 'max-age') == 0:
+                self.misses += 1
+                return None
+        vary = self.vary.get((method, request['path'], request['query']))
+        key = None if vary is None else self.key(request, vary)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        now = time.time()
+        if now >= entry.expires:
+            self.remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        headers = dict(entry.headers)
+        headers['age'] = str(int(now - entry.stored) + entry.age)
+        return {
+            'status': entry.status,
+            'headers': headers,
+            'body': entry.body,
+        }
+
+    def store(self, request, response):
+        """
+        Stores the response when it's cacheable, or invalidates the path of a
+        successful unsafe request.
+        """
+        method = request['method']
+        if method not in self.SAFE_METHODS:
+            if response['status'] < 400:
+                self.invalidate(request['path'])
+            return
+        if method not in self.CACHEABLE_METHODS or response['status'] not in self.CACHEABLE_STATUS:
+            return
+        body = response['body']
+        if not isinstance(body, (bytes, bytearray, memoryview)):
+            return
+        headers = response['headers']
+        cache_control = headers.get('cache-control')
+        if not cache_control or 'set-cookie' in headers:
+            return
+        directives = parse_cache_control(cache_control)
+        if 'no-store' in directives or 'no-cache' in directives or 'private' in directives:
+            return
+        if 'authorization' in request['headers'] and not (
+                'public' in directives or 's-maxage' in directives or 'must-revalidate' in directives):
+            return
+        max_age = cache_seconds(directives, 's-maxage')
+        if max_age is None:
+            max_age = cache_seconds(directives, 'max-age')
+        if not max_age or max_age < 0:
+            return
+        vary = tuple(sorted({name.strip().lower() for name in headers.get('vary', '').split(',')
+                             if name.strip()}))
+        if '*' in vary:
+            return
+        size = len(body) + sum(len(k) + len(v) for k, v in headers.items()) + self.ENTRY_OVERHEAD
+        if size > self.capacity // 4:
+            return
+        path = request['path']
+        base = (method, path, request['query'])
+        if self.vary.get(base, vary) != vary:
+            # the variants of the old Vary can't be found any more
+            self.invalidate(path)
+        key = self.key(request, vary)
+        if key in self.entries:
+            self.remove(key)
+        self.vary[base] = vary
+        self.variants[base] = self.variants.get(base, 0) + 1
+        age = cache_seconds(headers, 'age') or 0
+        self.entries[key] = CachedResponse(response, size, time.time(), max_age, age, path)
+        self.paths.setdefault(path, set()).add(key)
+        self.size += size
+        self.stores += 1
+        while self.size > self.capacity:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+        keys = self.paths[entry.path]
+        keys.discard(key)
+        if not keys:
+            del self.paths[entry.path]
+        base = key[:3]
+        count = self.variants[base] - 1
+        if count:
+            self.variants[base] = count
+        else:
+            del self.variants[base]
+            del self.vary[base]
+
+    def invalidate(self, path=None):
+        """
+        Removes the entries of the path, or all entries.
+        """
+        if path is None:
+            keys = list(self.entries)
+        else:
+            keys = list(self.paths.get(path, ()))
+        for key in keys:
+            self.remove(key)
+        self.invalidations += len(keys)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+class ConditionalResponses:
+    r"""
+    Answers If-None-Match/If-Modified-Since requests with 304 Not Modified
+    before the response goes to js. With config['etag'] a weak ETag hashed
+    from the body is attached to responses without one.
+
+    Applications can declare validators, so that a matching request is
+    answered without running the application at all:
+
+        import webcorn
+
+        @webcorn.validator(r'/articles/(?P<pk>\d+)/')
+        def article_etag(request, match):
+            return f'"{Article.objects.get(pk=match["pk"]).version}"'
+
+    The pattern is matched against the path below the app root, request is
+    the dict of method, path, query and headers, and the returned ETag(or
+    None to skip) is also attached to the response of the application.
+    """
+    METHODS = frozenset(('GET', 'HEAD'))
+    # headers a 304 keeps from the full response, set-cookie so that the
+    # application can still rotate session and csrf cookies
+    KEPT_HEADERS = ('server', 'etag', 'cache-control', 'content-location', 'date',
+                    'expires', 'vary', 'last-modified', 'set-cookie')
+
+    def __init__(self):
+        self.validators = []
+
+    def enabled(self):
+        return bool(config['etag'] or self.validators)
+
+    def validator(self, pattern):
+        def register(func):
+            self.validators.append((re.compile(pattern), func))
+            return func
+        return register
+
+    def declared_etag(self, request):
+        if request['method'] not in self.METHODS or not self.validators:
+            return None
+        path = request['path']
+        if path.startswith(app_root):
+            path = path[len(app_root):]
+        if not path.startswith('/'):
+            path = '/' + path
+        for pattern, func in self.validators:
+            match = pattern.fullmatch(path)
+            if match:
+                try:
+                    return func(request, match)
+                except Exception as e:
+                    # e.g. DoesNotExist, leave the request to the application
+                    logger.error("Validator %s failed for %s: %r", func.__name__, path, e)
+                    return None
+        return None
+
+    def not_modified(self, request, headers):
+        request_headers = request['headers']
+        if_none_match = request_headers.get('if-none-match')
+        if if_none_match is not None:
+            etag = headers.get('etag')
+            if etag is None:
+                return False
+            if if_none_match.strip() == '*':
+                return True
+            # weak comparison
+            etag = etag.removeprefix('W/')
+            return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+        if_modified_since = request_headers.get('if-modified-since')
+        last_modified = headers.get('last-modified')
+        if if_modified_since and last_modified:
+            try:
+                return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def not_modified_response(self, headers):
+        return {
+            'status': 304,
+            'headers': {name: headers[name] for name in self.KEPT_HEADERS if name in headers},
+            'body': b'',
+        }
+
+    def check(self, request):
+        """
+        Returns a 304 response when a declared validator matches the request,
+        otherwise the declared ETag(or None) for respond().
+        """
+        etag = self.declared_etag(request)
+        if etag is not None and self.not_modified(request, {'etag': etag}):
+            return self.not_modified_response({'server': server_version, 'etag': etag}), etag
+        return None, etag
+
+    def respond(self, request, response, etag=None):
+        """
+        Attaches the ETag to a buffered 200 response of GET/HEAD, and turns
+        it into 304 when the request's validators match.
+        """
+        if request['method'] not in self.METHODS or response['status'] != 200:
+            return response
+        body = response['body']
+        if not isinstance(body, (bytes, bytearray, memoryview)):
+            return response
+        headers = response['headers']
+        if 'etag' not in headers:
+            # the body of a HEAD is empty, its hash would not match GET's
+            if etag is None and config['etag'] and request['method'] == 'GET':
+                etag = f'W/"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+            if etag is not None:
+                headers['etag'] = etag
+        if self.not_modified(request, headers):
+            return self.not_modified_response(headers)
+        return response
+
+
+conditional = ConditionalResponses()
+validator = conditional.validator
+
+# more ranges than this in a Range header are ignored, the whole body is sent
+MAX_RANGES = 16
+
+
+def parse_range(header, size, max_open_range):
+    """
+    Parses the Range header for a body of size bytes into a list of
+    (first, last) byte positions. Returns None when the header is to be
+    ignored, and an empty list when no range is satisfiable.
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs:
+        return None
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if not first:
+                # suffix: the last N bytes
+                length = int(last)
+                if length > 0 and size > 0:
+                    ranges.append((max(size - length, 0), size - 1))
+                continue
+            first = int(first)
+            last = int(last) if last else None
+        except ValueError:
+            return None
+        if first < 0 or (last is not None and last < first):
+            return None
+        if first >= size:
+            continue
+        if last is None:
+            last = first + max_open_range - 1
+        ranges.append((first, min(last, size - 1)))
+    return ranges
+
+
+def partial_response(request, headers, size, read):
+    """
+    Answers the Range header of a GET request for a body of size bytes with
+    206(multipart/byteranges for several ranges) or 416, read(offset,
+    length) reads a piece of the body. Returns None when the whole body is to
+    be sent.
+    """
+    request_headers = request['headers']
+    header = request_headers.get('range')
+    if not header or request['method'] != 'GET':
+        return None
+    if_range = request_headers.get('if-range')
+    if if_range is not None:
+        if_range = if_range.strip()
+        # strong comparison, a weak ETag never matches
+        if if_range.startswith('W/') or if_range not in (headers.get('etag'), headers.get('last-modified')):
+            return None
+    ranges = parse_range(header, size, config['max_range'])
+    if ranges is None:
+        return None
+    headers = {k: v for k, v in headers.items() if k != 'content-length'}
+    headers['accept-ranges'] = 'bytes'
+    if not ranges:
+        headers['content-range'] = f'bytes */{size}'
+        return {'status': 416, 'headers': headers, 'body': b''}
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        headers['content-range'] = f'bytes {first}-{last}/{size}'
+        body = read(first, last - first + 1)
+    else:
+        boundary = secrets.token_hex(16)
+        content_type = headers.get('content-type', 'application/octet-stream')
+        parts = []
+        for first, last in ranges:
+            parts.append(f'--{boundary}\r\ncontent-type: {content_type}\r\n'
+                         f'content-range: bytes {first}-{last}/{size}\r\n\r\n'.encode())
+            parts.append(read(first, last - first + 1))
+            parts.append(b'\r\n')
+        parts.append(f'--{boundary}--\r\n'.encode())
+        body = b''.join(parts)
+        headers['content-type'] = f'multipart/byteranges; boundary={boundary}'
+    headers['content-length'] = str(len(body))
+    return {'status': 206, 'headers': headers, 'body': body}
+
+
+def file_reader(file, offset=0):
+    def read(start, length):
+        file.seek(offset + start)
+        return file.read(length)
+    return read
+
+
+class FileWrapper:
+    """
+    wsgi.file_wrapper, e.g. used by django FileResponse. It hands the file
+    to WsgiServer.handle_request, which answers Range requests by seeking it
+    instead of reading the whole file.
+    """
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration
+
+    def partial_response(self, request, headers):
+        file = self.filelike
+        try:
+            offset = file.tell()
+            size = os.fstat(file.fileno()).st_size - offset
+        except (AttributeError, OSError, ValueError):
+            return None
+        return partial_response(request, headers, size, file_reader(file, offset))
+
+
+def path_response(request, status, headers, path):
+    """
+    Response of an ASGI http.response.pathsend, answering Range requests.
+    """
+    with open(path, 'rb') as file:
+        if status == 200:
+            headers.setdefault('accept-ranges', 'bytes')
+            size = os.fstat(file.fileno()).st_size
+            ranged = partial_response(request, headers, size, file_reader(file))
+            if ranged is not None:
+                return ranged
+        body = b'' if request['method'] == 'HEAD' else file.read()
+    return {'status': status, 'headers': headers, 'body': body}
+
+
+class StaticFile:
+    __slots__ = ('path', 'size', 'content_type', 'encoding', 'etag', 'last_modified')
+
+    def __init__(self, path, stat):
+        self.path = path
+        self.size = stat.st_size
+        self.content_type, self.encoding = mimetypes.guess_type(path)
+        if self.content_type is None:
+            self.content_type = 'application/octet-stream'
+        self.etag = f'W/"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+        self.last_modified = formatdate(stat.st_mtime, usegmt=True)
+
+
+class StaticFiles:
+    """
+    Serves the files of the static roots of the application without running
+    it. The roots are found at startup: django STATIC_URL with the files of
+    the staticfiles finders and STATIC_ROOT, flask static_folder and
+    starlette/FastAPI StaticFiles mounts. Their files are indexed by url with
+    Content-Type, length and ETag computed once, so files added later are
+    left to the application. Small files are kept in a LRU bounded by bytes.
+    """
+    METHODS = frozenset(('GET', 'HEAD'))
+
+    def __init__(self, cache_size, cache_file_size):
+        # url prefix(below the app root) -> {relative url: StaticFile}
+        self.roots = {}
+        self.prefixes = []
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.cache_size = cache_size
+        self.cache_file_size = cache_file_size
+        self.hits = 0
+
+    def add_file(self, prefix, url, path):
+        files = self.roots.setdefault(prefix, {})
+        if url in files:
+            # the first root of a prefix wins, like the django finders
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        files[url] = StaticFile(path, stat)
+
+    def add_directory(self, prefix, directory):
+        directory = Path(directory)
+        if not directory.is_dir():
+            return
+        for root, _dirs, names in os.walk(directory):
+            for name in names:
+                path = Path(root) / name
+                self.add_file(prefix, path.relative_to(directory).as_posix(), str(path))
+
+    def url_prefix(self, url):
+        path = urlparse(url).path if '://' not in url else ''
+        if not path:
+            return None
+        if not path.startswith('/'):
+            path = '/' + path
+        elif app_root and path.startswith(app_root.rstrip('/') + '/'):
+            path = path[len(app_root.rstrip('/')):]
+        return path if path.endswith('/') else path + '/'
+
+    def discover(self, app):
+        if is_django:
+            self.discover_django()
+        static_folder = getattr(app, 'static_folder', None)
+        static_url_path = getattr(app, 'static_url_path', None)
+        if isinstance(static_folder, str) and isinstance(static_url_path, str):
+            self.add_directory(self.url_prefix(static_url_path or '/'), static_folder)
+        for route in getattr(app, 'routes', None) or []:
+            directories = getattr(getattr(route, 'app', None), 'all_directories', None)
+            path = getattr(route, 'path', None)
+            if directories and isinstance(path, str):
+                for directory in directories:
+                    self.add_directory(self.url_prefix(path), directory)
+        self.prefixes = sorted(self.roots, key=len, reverse=True)
+        count = sum(len(files) for files in self.roots.values())
+        logger.info("Indexed %d static files under %s", count, ', '.join(self.roots) or 'no roots')
+
+    def discover_django(self):
+        try:
+            from django.conf import settings
+            if 'django.contrib.staticfiles' not in settings.INSTALLED_APPS or not settings.STATIC_URL:
+                return
+            prefix = self.url_prefix(settings.STATIC_URL)
+            if prefix is None:
+                return
+            from django.contrib.staticfiles import finders
+            for finder in finders.get_finders():
+                for path, storage in finder.list(['CVS', '.*', '*~']):
+                    url = path.replace(os.sep, '/')
+                    # STATICFILES_DIRS entries may be (prefix, directory)
+                    if getattr(storage, 'prefix', None):
+                        url = f'{storage.prefix}/{url}'
+                    self.add_file(prefix, url, storage.path(path))
+            if settings.STATIC_ROOT:
+                self.add_directory(prefix, settings.STATIC_ROOT)
+        except Exception as e:
+            logger.error("Failed to index django static files: %s", e)
+
+    def find(self, request):
+        if request['method'] not in self.METHODS:
+            return None, None
+        path = request['path']
+        if app_root and path.startswith(app_root):
+            path = path[len(app_root):]
+        if not path.startswith('/'):
+            path = '/' + path
+        # the longest prefix first, roots may be nested
+        for prefix in self.prefixes:
+            if path.startswith(prefix):
+                file = self.roots[prefix].get(unquote(path[len(prefix):]))
+                if file is not None:
+                    return prefix, file
+        return None, None
+
+    def read(self, file):
+        body = self.cache.get(file.path)
+        if body is not None:
+            self.cache.move_to_end(file.path)
+            self.hits += 1
+            return body
+        with open(file.path, 'rb') as f:
+            body = f.read()
+        if len(body) <= self.cache_file_size:
+            self.cache[file.path] = body
+            self.cache_bytes += len(body)
+            while self.cache_bytes > self.cache_size:
+                _path, evicted = self.cache.popitem(last=False)
+                self.cache_bytes -= len(evicted)
+        return body
+
+    def read_range(self, file, start, length):
+        body = self.cache.get(file.path)
+        if body is not None:
+            return body[start:start + length]
+        with open(file.path, 'rb') as f:
+            f.seek(start)
+            return f.read(length)
+
+    def respond(self, request, sample):
+        """
+        Returns the response of a static file, or None to leave the request
+        to the application.
+        """
+        prefix, file = self.find(request)
+        if file is None:
+            return None
+        headers = {
+            'server': server_version,
+            'content-type': file.content_type,
+            'content-length': str(file.size),
+            'etag': file.etag,
+            'last-modified': file.last_modified,
+            'accept-ranges': 'bytes',
+        }
+        if file.encoding:
+            headers['content-encoding'] = file.encoding
+        if sample:
+            sample.route = prefix + '*'
+        if conditional.not_modified(request, headers):
+            return conditional.not_modified_response(headers)
+        if 'range' in request['headers']:
+            try:
+                ranged = partial_response(request, headers, file.size,
+                                          partial(self.read_range, file))
+            except OSError:
+                return None
+            if ranged is not None:
+                return ranged
+        if request['method'] == 'HEAD':
+            body = b''
+        else:
+            try:
+                body = self.read(file)
+            except OSError:
+                return None
+        return {'status': 200, 'headers': headers, 'body': body}
+
+
+# webcorn.py runs as __main__, applications import it as webcorn, e.g. to
+# declare validators
+if __name__ in sys.modules:
+    sys.modules.setdefault('webcorn', sys.modules[__name__])
+
+
+# header name caches, bounded so that random names can't grow them forever
+HEADER_CACHE_SIZE = 1024
+# request header name -> environ key, '' for headers that can't override
+# an environ key(CONTENT_TYPE, CONTENT_LENGTH and the CGI variables)
+environ_keys = {}
+# response header name -> lowercase name
+response_header_names = {}
+CGI_KEYS = frozenset((
+    'REQUEST_METHOD', 'SCRIPT_NAME', 'PATH_INFO', 'QUERY_STRING', 'SERVER_NAME',
+    'SERVER_PORT', 'SERVER_PROTOCOL', 'CONTENT_TYPE', 'CONTENT_LENGTH',
+))
+
+
+def environ_key(name):
+    key = name.replace('-', '_').upper()
+    key = '' if key in CGI_KEYS else sys.intern(f'HTTP_{key}')
+    if len(environ_keys) < HEADER_CACHE_SIZE:
+        environ_keys[name] = key
+    return key
+
+
+def response_header_name(name):
+    lower = sys.intern(name.lower())
+    if len(response_header_names) < HEADER_CACHE_SIZE:
+        response_header_names[name] = lower
+    return lower
+
+
 def normalize_headers(headers):
     oheaders = {}
+    names = response_header_names
     for k, v in headers:
-        k = k.lower()
+        try:
+            k = names[k]
+        except KeyError:
+            k = response_header_name(k)
         v = v.strip()
         if k == 'set-cookie':
             vs = v.split(';')
@@ -171,9 +2044,200 @@ def normalize_headers(headers):
     return oheaders
 
 
-class WsgiServer:
+class RequestTimeout(BaseException):
+    """
+    Raised at a checkpoint of a WSGI request past its time budget. It's not
+    an Exception, so that applications(e.g. django turning exceptions of
+    views into 500) let it through to the server, which answers 504.
+    """
+
+
+class Deadline:
+    """
+    Time slice and budget of a WSGI request run by run_wsgi_async.
+    """
+    __slots__ = ('expires', 'slice', 'next_yield', 'timed_out')
+
+    def __init__(self, timeout, slice_ms):
+        now = time.perf_counter()
+        self.expires = now + timeout if timeout else None
+        self.slice = slice_ms / 1000
+        self.next_yield = now + self.slice
+        self.timed_out = False
+
+    def due(self):
+        """
+        Whether the time slice is used up, raises RequestTimeout past the budget.
+        """
+        now = time.perf_counter()
+        if self.expires is not None and now > self.expires:
+            self.timed_out = True
+            raise RequestTimeout()
+        if now >= self.next_yield:
+            self.next_yield = now + self.slice
+            return True
+        return False
+
+
+request_deadline = ContextVar('request_deadline', default=None)
+
+
+def checkpoint():
+    """
+    Lets a WSGI application run by run_wsgi_async give way to other requests
+    in long running code: yields to the event loop when the time slice of
+    the request is used up(only possible with JSPI, see can_run_sync), and
+    raises RequestTimeout when the request is past its time budget.
+    """
+    deadline = request_deadline.get()
+    if deadline is not None and deadline.due() and can_run_sync():
+        run_sync(asyncio.sleep(0))
+
+
+class WsgiResponseStream:
+    """
+    Pull based reader over the body of a streaming WSGI response.
+    The application iterator is advanced lazily, one chunk per pull, and
+    closed once it is exhausted, fails, or the reader gives up.
+    """
     def __init__(self):
+        self.app_iter = None
+        self.iterator = None
+        # chunks from the legacy write() callable and the one just pulled
+        self.pending = deque()
+        self.closed = False
+        self.last_used = time.perf_counter()
+
+    def write(self, data):
+        if data:
+            self.pending.append(data)
+
+    def start(self, app_iter):
+        self.app_iter = app_iter
+        self.iterator = iter(app_iter)
+        # A generator application calls start_response on its first iteration
+        self.advance()
+
+    def advance(self):
+        try:
+            data = next(self.iterator)
+        except StopIteration:
+            self.close()
+            return
+        except Exception:
+            self.close()
+            raise
+        if data:
+            self.pending.append(data)
+
+    def next_chunk(self):
+        while not self.pending and not self.closed:
+            self.advance()
+        if self.pending:
+            return self.pending.popleft()
+        return None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.clear()
+        if self.app_iter is not None and hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+
+class WsgiExchange:
+    """
+    One call of the WSGI application by WsgiServer: the environ, the status
+    and headers set by start_response, and the body buffered by run().
+    """
+    __slots__ = ('request', 'sample', 'environ', 'status', 'headers', 'body', 'write',
+                 'app_iter', 'ranged')
+
+    def __init__(self, server, request, sample):
+        self.request = request
+        self.sample = sample
+        self.environ = server.build_environ(request, server.errors)
+        if sample:
+            sample.built = time.perf_counter()
+        self.status = 0
+        self.headers = {
+            'server': server_version,
+        }
+        self.body = BytesIO()
+        # the write() callable, replaced by the stream of a streaming response
+        self.write = self.body.write
+        self.app_iter = None
+        self.ranged = None
+
+    def start_response(self, status, headers, exc_info=None):
+        if self.status != 0 and not exc_info:
+            raise AssertionError("Headers already set")
+        code, _msg = status.split(None, 1)
+        self.status = int(code)
+        self.headers.update(normalize_headers(headers))
+        return self.write
+
+    def call(self):
+        self.app_iter = application(self.environ, self.start_response)
+        if self.sample:
+            self.sample.called = time.perf_counter()
+        return self.app_iter
+
+    def run(self):
+        """
+        Calls the application and buffers the body, yielding after each
+        chunk so that the caller can give way in between.
+        """
+        self.call()
+        if isinstance(self.app_iter, FileWrapper) and self.status == 200:
+            self.headers.setdefault('accept-ranges', 'bytes')
+            if 'range' in self.request['headers']:
+                # seeks the file for the ranges instead of reading it all
+                self.ranged = self.app_iter.partial_response(self.request, self.headers)
+                if self.ranged is not None:
+                    return
+        for data in self.app_iter:
+            self.write(data)
+            yield
+
+    def close(self):
+        if self.app_iter and hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+    def finish(self):
+        if self.sample:
+            self.sample.finished = time.perf_counter()
+            self.sample.route = route_template(self.environ['PATH_INFO'], self.environ)
+        if self.ranged is not None:
+            return self.ranged
+        return {
+            'status': self.status,
+            'headers': self.headers,
+            'body': self.body.getbuffer(),
+        }
+
+
+class WsgiServer:
+    def __init__(self, max_streams=100, stream_idle_timeout=60):
         self.startup_failed = False
+        # stream id -> WsgiResponseStream, least recently read first
+        self.streams = OrderedDict()
+        self.max_streams = max_streams
+        self.stream_idle_timeout = stream_idle_timeout
+        self.next_stream_id = 1000
+        self.errors = ErrorStream()
+        # the keys that are the same for every request, copied by build_environ
+        self.base_environ = {
+            'SCRIPT_NAME': app_root,
+            'SERVER_PROTOCOL': 'HTTP/1.0',
+            'wsgi.version': (1, 0),
+            'wsgi.errors': self.errors,
+            'wsgi.file_wrapper': FileWrapper,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
 
     async def check_django(self):
         """django开发态的静态文件处理比较特殊，需要在这里单独配置"""
@@ -183,9 +2247,6 @@ class WsgiServer:
             installed_apps = settings.INSTALLED_APPS
             is_django = True
 
-            # Django need tzdata
-            await micropip.install('tzdata')
-
             # Django check running event loop
             os.environ['DJANGO_ALLOW_ASYNC_UNSAFE'] = 'true'
 
@@ -210,6 +2271,25 @@ class WsgiServer:
                 application = StaticFilesHandler(application)
         except Exception:
             pass
+        if is_django:
+            await self.load_django_dependencies()
+
+    async def load_django_dependencies(self):
+        """
+        Loads the database backends(sqlite3) and the time zone(tzdata) now,
+        their packages are installed on demand, rather than failing the first
+        request that needs them.
+        """
+        try:
+            from django.conf import settings
+            from django.db import connections
+            for alias in connections:
+                await call_installing_missing(connections.__getitem__, alias)
+            if settings.USE_TZ:
+                from django.utils.timezone import get_default_timezone
+                await call_installing_missing(get_default_timezone)
+        except Exception as e:
+            logger.error("Failed to load django dependencies: %s", e)
 
     async def startup(self):
         await self.check_django()
@@ -218,23 +2298,17 @@ class WsgiServer:
         pathname = request['path']
         if pathname.startswith(app_root):
             pathname = pathname[len(app_root):]
-        stdin = BytesIO(request['body'])
-        environ = {
-            'REQUEST_METHOD': request['method'],
-            'SCRIPT_NAME': app_root,
-            'PATH_INFO': pathname,
-            'QUERY_STRING': request['query'],
-            'SERVER_NAME': request['server'],
-            'SERVER_PORT': str(request['port']) or ('443' if request['scheme'] == 'https' else '80'),
-            'SERVER_PROTOCOL': 'HTTP/1.0',
-            'wsgi.version': (1, 0),
-            'wsgi.url_scheme': request['scheme'],
-            'wsgi.input': stdin,
-            'wsgi.errors': stderr,
-            'wsgi.multithread': False,
-            'wsgi.multiprocess': True,
-            'wsgi.run_once': False,
-        }
+        stdin = RequestBody(request['body'])
+        environ = self.base_environ.copy()
+        environ['REQUEST_METHOD'] = request['method']
+        environ['PATH_INFO'] = pathname
+        environ['QUERY_STRING'] = request['query']
+        environ['SERVER_NAME'] = request['server']
+        environ['SERVER_PORT'] = str(request['port']) or ('443' if request['scheme'] == 'https' else '80')
+        environ['wsgi.url_scheme'] = request['scheme']
+        environ['wsgi.input'] = stdin
+        if stderr is not self.errors:
+            environ['wsgi.errors'] = stderr
         headers = request['headers']
         if 'content-type' in headers:
             environ['CONTENT_TYPE'] = headers['content-type']
@@ -243,14 +2317,16 @@ class WsgiServer:
         if 'content-length' in headers:
             environ['CONTENT_LENGTH'] = headers['content-length']
         else:
-            environ['CONTENT_LENGTH'] = str(len(request['body']))
-
-        for k, v in headers.items():
-            k = k.replace('-', '_').upper()
-            v = v.strip()
-            if k in environ:
+            environ['CONTENT_LENGTH'] = str(len(stdin))
+
+        keys = environ_keys
+        for name, v in headers.items():
+            k = keys.get(name)
+            if k is None:
+                k = environ_key(name)
+            if not k:
                 continue
-            k = f'HTTP_{k}'
+            v = v.strip()
             if k in environ:
                 environ[k] += ',' + v
             else:
@@ -258,49 +2334,352 @@ class WsgiServer:
         return environ
 
 
-    def handle_request(self, request):
-        stdout = BytesIO()
-        stderr = ErrorStream(js_console)
-        environ = self.build_environ(request, stderr)
+    def handle_request(self, request, stream=False, sample=None):
+        exchange = WsgiExchange(self, request, sample)
+        if stream:
+            response_stream = WsgiResponseStream()
+            exchange.write = response_stream.write
+            response_stream.start(exchange.call())
+            if sample:
+                sample.route = route_template(exchange.environ['PATH_INFO'], exchange.environ)
+            stream_id = f'stream-{self.next_stream_id}'
+            self.next_stream_id += 1
+            self.evict_streams()
+            self.streams[stream_id] = response_stream
+            return {
+                'status': exchange.status,
+                'headers': exchange.headers,
+                'body': stream_id,
+            }
 
-        options = {
-            'status': 0,
+        try:
+            for _ in exchange.run():
+                pass
+        except Exception as e:
+            print(e)
+            raise
+        finally:
+            exchange.close()
+        return exchange.finish()
+
+    async def handle_request_async(self, request, sample=None):
+        """
+        Buffered handle_request that yields to the event loop between body
+        chunks once the time slice is used up, so that other requests and
+        the ASGI lifespan make progress, and answers 504 past the budget.
+        The application itself can only give way at checkpoint().
+        """
+        exchange = WsgiExchange(self, request, sample)
+        deadline = Deadline(config['wsgi_timeout'], config['wsgi_slice_ms'])
+        token = request_deadline.set(deadline)
+        try:
+            for _ in exchange.run():
+                if deadline.due():
+                    await asyncio.sleep(0)
+            if deadline.timed_out:
+                # RequestTimeout was caught by the application
+                raise RequestTimeout()
+        except RequestTimeout:
+            logger.error("Request %s %s timed out after %ss",
+                         request['method'], request['path'], config['wsgi_timeout'])
+            return self.gateway_timeout()
+        finally:
+            request_deadline.reset(token)
+            exchange.close()
+        return exchange.finish()
+
+    def gateway_timeout(self):
+        return {
+            'status': 504,
             'headers': {
                 'server': server_version,
+                'content-type': 'text/plain; charset=utf-8',
             },
+            'body': b'Gateway Timeout',
+        }
+
+    def next_chunk(self, stream_id):
+        """
+        Returns the next body chunk of a streaming response, or None when
+        the body is exhausted.
+        """
+        response_stream = self.streams.get(stream_id)
+        if response_stream is None:
+            return None
+        self.streams.move_to_end(stream_id)
+        response_stream.last_used = time.perf_counter()
+        try:
+            chunk = response_stream.next_chunk()
+        except Exception:
+            del self.streams[stream_id]
+            raise
+        if chunk is None:
+            del self.streams[stream_id]
+        return chunk
+
+    def close_stream(self, stream_id):
+        response_stream = self.streams.pop(stream_id, None)
+        if response_stream is not None:
+            response_stream.close()
+
+    def evict_streams(self):
+        """
+        Closes the streams left unread for stream_idle_timeout, and the least
+        recently read ones beyond max_streams - 1, making room for a new one.
+        """
+        idle_since = time.perf_counter() - self.stream_idle_timeout
+        while self.streams:
+            stream_id, response_stream = next(iter(self.streams.items()))
+            if len(self.streams) < self.max_streams and response_stream.last_used > idle_since:
+                break
+            logger.info("Closing unread response stream %s", stream_id)
+            self.close_stream(stream_id)
+
+
+class ResponseState:
+    """
+    Response of an ASGI application instance. The body goes either to
+    output(buffered) or to body_queue(streaming). ready is set when
+    handle_request can return: on http.response.start when streaming,
+    once the body is complete otherwise.
+    """
+    __slots__ = ('output', 'body_queue', 'started', 'complete', 'ready', 'status', 'headers', 'error',
+                 'path')
+
+    def __init__(self, stream, buffer_chunks):
+        if stream:
+            self.output = None
+            self.body_queue = asyncio.Queue(buffer_chunks)
+        else:
+            self.output = BytesIO()
+            self.body_queue = None
+        self.started = False
+        self.complete = False
+        self.ready = asyncio.Event()
+        self.status = 500
+        self.headers = {'server': server_version}
+        # set if the application failed before completing the response
+        self.error = None
+        # file of a http.response.pathsend
+        self.path = None
+
+
+class AppInstance:
+    __slots__ = ('id', 'scope', 'body', 'input_queue', 'future', 'response')
+
+    def __init__(self, instance_id, scope, body, response):
+        self.id = instance_id
+        self.scope = scope
+        self.body = body
+        # Only created if the application keeps receiving after the body
+        self.input_queue = None
+        self.future = None
+        self.response = response
+
+
+class AsgiResponseStream:
+    """
+    Async iterator over the body chunks of a streaming ASGI response.
+    The application instance is removed when the body is exhausted, the
+    iterator is closed by the reader, or it's left unread, see watch_stream.
+    """
+    def __init__(self, server, instance_id, response):
+        self.server = server
+        self.instance_id = instance_id
+        self.response = response
+        self.closed = False
+        self.last_used = time.perf_counter()
+        # the reader waits for the application, the stream is not idle
+        self.reading = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed:
+            raise StopAsyncIteration
+        body_queue = self.response.body_queue
+        if body_queue.empty() and self.response.complete:
+            chunk = None
+        else:
+            self.reading = True
+            try:
+                chunk = await body_queue.get()
+            finally:
+                self.reading = False
+                self.last_used = time.perf_counter()
+        if self.closed:
+            raise StopAsyncIteration
+        if chunk is None:
+            await self.aclose()
+            if self.response.error is not None:
+                raise self.response.error
+            raise StopAsyncIteration
+        return chunk
+
+    async def aclose(self):
+        self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.server.delete_application_instance(self.instance_id)
+
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight GET/HEAD requests: the first one runs the
+    application, the others wait for its response(or its exception). When
+    the first one is cancelled, a waiting request runs the application in
+    its place.
+    """
+    METHODS = frozenset(('GET', 'HEAD'))
+
+    def __init__(self, headers):
+        self.headers = tuple(name.lower() for name in headers)
+        self.inflight = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def run(self, request, func, *args):
+        if request['method'] not in self.METHODS:
+            return await func(*args)
+        headers = request['headers']
+        key = (request['method'], request['path'], request['query'],
+               *(headers.get(name) for name in self.headers))
+        while (future := self.inflight.get(key)) is not None:
+            try:
+                response = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # the leader was cancelled, not this request
+                continue
+            self.coalesced += 1
+            # the layers after the application may change the headers
+            return {
+                'status': response['status'],
+                'headers': dict(response['headers']),
+                'body': response['body'],
+            }
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        self.leaders += 1
+        try:
+            response = await func(*args)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # retrieved, no warning when nobody waited
+            future.exception()
+            raise
+        finally:
+            del self.inflight[key]
+        future.set_result(response)
+        return response
+
+    def stats(self):
+        total = self.leaders + self.coalesced
+        return {
+            'coalesce_leaders': self.leaders,
+            'coalesced': self.coalesced,
+            'coalesce_ratio': self.coalesced / total if total else 0.0,
         }
 
-        def start_response(status, headers, exc_info=None):
-            if options['status'] != 0 and not exc_info:
-                raise AssertionError("Headers already set")
-            code, _msg = status.split(None, 1)
-            options['status'] = int(code)
-            options['headers'].update(normalize_headers(headers))
-            return stdout.write
 
+class AdmissionController:
+    """
+    Bounds the number of requests running in the application at once.
+    Requests over the limit wait in a bounded FIFO queue; a request is
+    rejected when the queue is full or its deadline passes while waiting.
+    """
+    def __init__(self, max_concurrency, max_queue, timeout):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiters = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def acquire(self):
+        """
+        Waits for a free slot, returns False if the request is rejected.
+        """
+        if self.active < self.max_concurrency and not self.waiters:
+            self.active += 1
+            self.admitted += 1
+            return True
+        if len(self.waiters) >= self.max_queue:
+            self.rejected += 1
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        begin = time.perf_counter()
         try:
-            app_iter = application(environ, start_response)
-            for data in app_iter:
-                stdout.write(data)
-        except Exception as e:
-            print(e)
+            await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            if not waiter.done() or waiter.cancelled():
+                self.timed_out += 1
+                return False
+            # release() handed the slot over in the same loop iteration as
+            # the timeout, the request holds it now
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the cancellation
+            if waiter.done() and not waiter.cancelled():
+                self.release()
             raise
         finally:
-            if app_iter and hasattr(app_iter, 'close'):
-                app_iter.close()
+            if not waiter.done() or waiter.cancelled():
+                try:
+                    self.waiters.remove(waiter)
+                except ValueError:
+                    pass
+        wait = time.perf_counter() - begin
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        return True
+
+    def release(self):
+        # Hand the slot over to the first waiter still waiting
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.active -= 1
+
+    def stats(self):
         return {
-            'status': options['status'],
-            'headers': options['headers'],
-            'body': stdout.getbuffer(),
+            'active': self.active,
+            'queued': len(self.waiters),
+            'max_concurrency': self.max_concurrency,
+            'max_queue': self.max_queue,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'avg_wait_ms': self.total_wait * 1000 / self.admitted if self.admitted else 0.0,
+            'max_wait_ms': self.max_wait * 1000,
         }
 
 
 class AsgiServer:
     STATE_TRANSITION_ERROR = "Got invalid state transition on lifespan protocol."
-    APPLICATION_CHECKER_INTERVAL = 0.1
-    def __init__(self, max_app_count=1000):
+    STREAM_BUFFER_CHUNKS = 16
+    def __init__(self, max_app_count=1000, max_concurrency=100, max_queue=1000,
+                 queue_timeout=30, retry_after=1, stream_idle_timeout=60):
         self.max_app_count = max_app_count
-        self.instances = {}
+        self.stream_idle_timeout = stream_idle_timeout
+        self.admission = AdmissionController(max_concurrency, max_queue, queue_timeout)
+        self.retry_after = retry_after
+        # instance id -> AppInstance, least recently used first
+        self.instances = OrderedDict()
         self.next_instance_id = 1000
         self.state = {}
         self.logger = Logger('webcorn.error')
@@ -315,7 +2694,6 @@ class AsgiServer:
 
     async def startup(self):
         self.logger.info("Waiting for application startup.")
-        checker_task = asyncio.create_task(self.application_checker())
         main_lifespan_task = asyncio.create_task(self.lifespan())  # noqa: F841
         # Keep a hard reference to prevent garbage collection
         # See https://github.com/encode/uvicorn/pull/972
@@ -408,39 +2786,110 @@ class AsgiServer:
             'client': None,
             'server': [request['server'], request['port']],
             'state': self.state.copy(),
+            'extensions': {
+                'http.response.pathsend': {},
+            },
         }
         return scope
 
-    async def handle_request(self, request):
+    async def handle_request(self, request, stream=False, sample=None):
+        if not await self.admission.acquire():
+            if sample:
+                sample.route = route_template(request['path'], {})
+            return self.service_unavailable()
         scope = self.build_scope(request)
         instance_id = f'inst-{self.next_instance_id}'
         self.next_instance_id += 1
-        instance = self.get_or_create_application_instance(instance_id, scope)
-        instance['input_queue'].put_nowait({'type': 'http.request', 'body': request['body']})
-        webcorn = instance['webcorn']
-        await webcorn['message_event'].wait()
-        webcorn['message_event'].clear()
-        result = {
-            'status': webcorn['status'],
-            'headers': webcorn['headers'],
-            'body': webcorn['output'].getbuffer(),
-        }
-        self.delete_application_instance(instance_id)
+        body = RequestBody(request['body'])
+        if sample:
+            sample.built = time.perf_counter()
+        instance = self.get_or_create_application_instance(instance_id, scope, body, stream)
+        response = instance.response
+        await response.ready.wait()
+        if response.error is not None:
+            self.delete_application_instance(instance_id)
+            raise response.error
+        if sample:
+            sample.called = time.perf_counter()
+            sample.route = route_template(scope['path'], scope)
+        if stream:
+            # 收到http.response.start即返回，响应体由AsgiResponseStream逐块读取
+            response_stream = AsgiResponseStream(self, instance_id, response)
+            if self.stream_idle_timeout:
+                self.watch_stream(response_stream)
+            return {
+                'status': response.status,
+                'headers': response.headers,
+                'body': response_stream,
+            }
+        if response.path is not None:
+            try:
+                result = path_response(request, response.status, response.headers, response.path)
+            finally:
+                self.delete_application_instance(instance_id)
+        else:
+            result = {
+                'status': response.status,
+                'headers': response.headers,
+                'body': response.output.getbuffer(),
+            }
+            self.delete_application_instance(instance_id)
+        if sample:
+            sample.finished = time.perf_counter()
         return result
 
+    def watch_stream(self, response_stream):
+        """
+        Closes the stream once it's left unread for stream_idle_timeout. The
+        application blocked on the full body queue is cancelled, which frees
+        its admission slot.
+        """
+        if response_stream.closed:
+            return
+        idle = time.perf_counter() - response_stream.last_used
+        if response_stream.reading:
+            idle = 0
+        if idle >= self.stream_idle_timeout:
+            self.logger.info("Closing unread response stream %s", response_stream.instance_id)
+            response_stream.close()
+            return
+        asyncio.get_running_loop().call_later(self.stream_idle_timeout - idle,
+                                              self.watch_stream, response_stream)
+
+    def service_unavailable(self):
+        return {
+            'status': 503,
+            'headers': {
+                'server': server_version,
+                'content-type': 'text/plain; charset=utf-8',
+                'retry-after': str(self.retry_after),
+            },
+            'body': b'Service Unavailable',
+        }
+
+    async def application_receive(self, instance_id):
+        instance = self.instances[instance_id]
+        body = instance.body
+        if not body.complete:
+            # The body is sliced into bounded chunks as the application asks for them
+            return body.next_message()
+        if instance.input_queue is None:
+            instance.input_queue = asyncio.Queue()
+        return await instance.input_queue.get()
+
     async def application_send(self, instance_id, message):
         instance = self.instances[instance_id]
-        webcorn = instance['webcorn']
-        scope = instance['scope']
+        response = instance.response
+        scope = instance.scope
         message_type = message["type"]
-        if not webcorn.get('response_started'):
+        if not response.started:
             if message_type != 'http.response.start':
                 msg = 'Expected ASGI message "http.response.start", but got "%s".'
                 raise RuntimeError(msg % message_type)
-            webcorn['response_started'] = True
-            webcorn['status'] = message['status']
+            response.started = True
+            response.status = message['status']
             headers = [(k.decode(), v.decode()) for (k, v) in message.get('headers', [])]
-            webcorn['headers'].update(normalize_headers(headers))
+            response.headers.update(normalize_headers(headers))
             path_with_query_string = scope.get('path')
             if scope.get('query_string'):
                 path_with_query_string += '?' + scope.get('query_string').decode()
@@ -451,8 +2900,16 @@ class AsgiServer:
                 path_with_query_string,
                 scope["http_version"],
                 message['status'],
+                method=scope["method"],
+                path=path_with_query_string,
+                status=message['status'],
             )
-        elif not webcorn.get('response_complete'):
+            if response.body_queue is not None:
+                response.ready.set()
+        elif not response.complete:
+            if message_type == "http.response.pathsend":
+                await self.send_path(response, scope, message['path'])
+                return
             # Sending response body
             if message_type != "http.response.body":
                 msg = "Expected ASGI message 'http.response.body', but got '%s'."
@@ -461,145 +2918,207 @@ class AsgiServer:
             more_body = message.get("more_body", False)
             # Write response body
             data = b"" if scope["method"] == "HEAD" else body
-            output = webcorn['output']
-            output.write(data)
+            body_queue = response.body_queue
+            if body_queue is not None:
+                # The queue is bounded, a slow reader suspends the application here
+                if data:
+                    await body_queue.put(data)
+                if not more_body:
+                    await body_queue.put(None)
+                    response.complete = True
+                return
+            response.output.write(data)
             # Handle response completion
             if not more_body:
-                webcorn['response_complete'] = True
-                webcorn['message_event'].set()
+                response.complete = True
+                response.ready.set()
         else:
             # Response already sent
             msg = "Unexpected ASGI message '%s' sent, after response already completed."
             raise RuntimeError(msg % message_type)
 
-    async def application_checker(self):
+    async def send_path(self, response, scope, path):
         """
-        Goes through the set of current application instance Futures and cleans up
-        any that are done/prints exceptions for any that errored.
+        http.response.pathsend: the buffered response reads the file in
+        handle_request(see path_response), a stream reads it chunk by chunk.
         """
-        while True:
-            await asyncio.sleep(self.APPLICATION_CHECKER_INTERVAL)
-            for instance_id, instance in list(self.instances.items()):
-                if instance["future"].done():
-                    exception = instance["future"].exception()
-                    if exception:
-                        await self.application_exception(exception, instance)
-                    try:
-                        del self.instances[instance_id]
-                    except KeyError:
-                        # Exception handling might have already got here before us. That's fine.
-                        pass
-
-    async def application_exception(self, exception, application_details):
+        body_queue = response.body_queue
+        if body_queue is None:
+            response.path = path
+            response.complete = True
+            response.ready.set()
+            return
+        if scope["method"] != "HEAD":
+            with open(path, 'rb') as file:
+                while chunk := file.read(RequestBody.CHUNK_SIZE):
+                    await body_queue.put(chunk)
+        await body_queue.put(None)
+        response.complete = True
+
+    def application_done(self, instance):
+        """
+        Done callback of an application instance future. Reports exceptions,
+        fails the request if the response was not completed, and removes the
+        instance.
+        """
+        future = instance.future
+        response = instance.response
+        if future.cancelled():
+            exception = RuntimeError("ASGI application instance was cancelled.")
+        else:
+            exception = future.exception()
+            if exception:
+                self.application_exception(exception, instance)
+        if not response.complete:
+            if exception is None:
+                exception = RuntimeError("ASGI callable returned without completing response.")
+            response.complete = True
+            response.error = exception
+            # A full queue is drained by the reader, which then sees response.complete
+            body_queue = response.body_queue
+            if body_queue is not None and not body_queue.full():
+                body_queue.put_nowait(None)
+            response.ready.set()
+        if self.instances.get(instance.id) is instance:
+            del self.instances[instance.id]
+        self.admission.release()
+
+    def application_exception(self, exception, application_details):
         """
         Called whenever an application coroutine has an exception.
         """
-        logging.error(
+        self.logger.error(
             "Exception inside application: %s\n%s%s",
             exception,
             "".join(traceback.format_tb(exception.__traceback__)),
             f"  {exception}",
-        ) 
+        )
 
-    def get_or_create_application_instance(self, instance_id, scope):
+    def get_or_create_application_instance(self, instance_id, scope, body, stream=False):
         """
-        Creates an application instance and returns its queue.
+        Creates an application instance and returns it.
         """
         if instance_id in self.instances:
-            self.instances[instance_id]["last_used"] = time.time()
+            self.instances.move_to_end(instance_id)
             return self.instances[instance_id]
         # See if we need to delete an old one
         while len(self.instances) > self.max_app_count:
             self.delete_oldest_application_instance()
         # Make an instance of the application
-        input_queue = asyncio.Queue()
+        response = ResponseState(stream, self.STREAM_BUFFER_CHUNKS)
+        instance = AppInstance(instance_id, scope, body, response)
         # Run it, and stash the future for later checking
-        future = asyncio.ensure_future(
+        instance.future = asyncio.ensure_future(
             application(
                 scope=scope,
-                receive=input_queue.get,
+                receive=lambda: self.application_receive(instance_id),
                 send=lambda message: self.application_send(instance_id, message),
             ),
         )
-        self.instances[instance_id] = {
-            "id": instance_id,
-            "input_queue": input_queue,
-            "future": future,
-            "scope": scope,
-            "last_used": time.time(),
-            'webcorn': {
-                'output': BytesIO(),
-                'response_started': False,
-                'response_complete': False,
-                'message_event': asyncio.Event(),
-                'status': 500,
-                'headers': {
-                    'server': server_version,
-                },
-            },
-        }
-        return self.instances[instance_id]
+        instance.future.add_done_callback(lambda future: self.application_done(instance))
+        self.instances[instance_id] = instance
+        return instance
 
     def delete_oldest_application_instance(self):
         """
         Finds and deletes the oldest application instance
         """
-        oldest_time = min(
-            instance["last_used"] for instance in self.instances.values()
-        )
-        for instance_id, instance in self.instances.items():
-            if instance["last_used"] == oldest_time:
-                self.delete_application_instance(instance_id)
-                # Return to make sure we only delete one in case two have
-                # the same oldest time
-                return
+        instance_id = next(iter(self.instances))
+        self.delete_application_instance(instance_id)
 
     def delete_application_instance(self, instance_id):
         """
         Removes an application instance (makes sure its task is stopped,
         then removes it from the current set)
         """
-        instance = self.instances[instance_id]
-        del self.instances[instance_id]
-        if not instance["future"].done():
-            instance["future"].cancel()
+        instance = self.instances.pop(instance_id, None)
+        if instance is None:
+            # Already removed by application_done
+            return
+        if not instance.future.done():
+            instance.future.cancel()
 
 
 async def start_wsgi():
     global wsgi_server
-    wsgi_server = WsgiServer()
+    wsgi_server = WsgiServer(
+        max_streams=config['max_streams'],
+        stream_idle_timeout=config['stream_idle_timeout'],
+    )
     await wsgi_server.startup()
     return not wsgi_server.startup_failed
 
 async def start_asgi():
     global asgi_server
-    asgi_server = AsgiServer()
+    asgi_server = AsgiServer(
+        max_concurrency=config['max_concurrency'],
+        max_queue=config['max_queue'],
+        queue_timeout=config['queue_timeout'],
+        retry_after=config['retry_after'],
+        stream_idle_timeout=config['stream_idle_timeout'],
+    )
     await asgi_server.startup()
     return not asgi_server.startup_failed
 
-async def load_app(project_root, app_spec, app_url, console):
-    global application, is_wsgi, is_asgi, js_console
+async def load_app(project_root, app_spec, app_url, console, options=None):
+    """
+    Loads and starts the application, returns the startup report of
+    StartupProfiler.
+    """
+    global js_console
     js_console = console
-    await setup(project_root, app_spec, app_url)
+    if options:
+        if hasattr(options, 'to_py'):
+            options = options.to_py()
+        config.update(options)
+    profiler = StartupProfiler()
+    if config['profile_imports']:
+        profiler.hook_imports()
+    try:
+        await start_app(project_root, app_spec, app_url, profiler)
+    finally:
+        profiler.unhook_imports()
+        profiler.log_summary()
+        log_sink.flush()
+    return to_js(profiler.report(), dict_converter=Object.fromEntries)
+
+
+async def start_app(project_root, app_spec, app_url, profiler):
+    global application, is_wsgi, is_asgi, request_profiler, response_cache, static_files, single_flight
+    await lazy_installer.register()
+    await setup(project_root, app_spec, app_url, profiler)
     _, _, apppath = app_spec.rpartition('/')
     pypath, _, appname = apppath.partition(':')
     if not pypath:
         pypaths = ['main', 'app', 'api']
     else:
         pypaths = [pypath]
-    for p in pypaths:
-        try:
-            module = import_module(p)
-            pypath = p
-            break
-        except ModuleNotFoundError as e:
-            if len(pypaths) == 1:
-                raise
-            if e.name != p:
-                raise
-            module = None
+    modules_before = set(sys.modules)
+    import_begin = time.time()
+    import_perf_begin = time.perf_counter()
+    with profiler.phase('import_app'):
+        for p in pypaths:
+            try:
+                module = await call_installing_missing(import_module, p)
+                pypath = p
+                break
+            except ModuleNotFoundError as e:
+                if len(pypaths) == 1:
+                    raise
+                if e.name != p:
+                    raise
+                module = None
     if not module:
         raise RuntimeError(f"Can't find app module")
+    import_ms = (time.perf_counter() - import_perf_begin) * 1000
+    loaded, compiled = bytecode_report(modules_before, import_begin)
+    profiler.extra['bytecode'] = {'loaded': loaded, 'compiled': compiled}
+    if bytecode_cache and bytecode_cache.enabled and bytecode_cache.compile_ms:
+        logger.info("Imported %s in %.2fms: %d modules from bytecode(saved about %.2fms), %d compiled",
+                    pypath, import_ms, loaded, loaded * bytecode_cache.compile_ms, compiled)
+    else:
+        logger.info("Imported %s in %.2fms: %d modules from bytecode, %d compiled",
+                    pypath, import_ms, loaded, compiled)
     if not appname:
         appnames = ['app', 'api']
     else:
@@ -622,19 +3141,274 @@ async def load_app(project_root, app_spec, app_url, console):
     if not is_wsgi and not is_asgi:
         raise RuntimeError(f"app object should be wsgi app or asgi app")
     application = instance
-    if is_wsgi:
-        await start_wsgi()
-    if is_asgi:
-        await start_asgi()
+    if config['response_cache']:
+        response_cache = ResponseCache(config['response_cache'])
+    if config['coalesce'] and is_asgi:
+        single_flight = SingleFlight(config['coalesce_headers'])
+    if config['profile']:
+        request_profiler = RequestProfiler(config['profile_header'], config['profile_sample'],
+                                           config['profile_history'], config['profile_top'])
+    with profiler.phase('startup'):
+        if is_wsgi:
+            await start_wsgi()
+        if is_asgi:
+            await start_asgi()
+    if config['static_files']:
+        with profiler.phase('index_static_files'):
+            static_files = StaticFiles(config['static_cache'], config['static_cache_file'])
+            static_files.discover(instance)
+    if bytecode_cache and bytecode_cache.enabled:
+        with profiler.phase('persist_bytecode'):
+            await bytecode_cache.persist()
+
+
+EMPTY_BODY = memoryview(b'')
+
+
+def request_to_py(request):
+    """
+    Converts the request from js, only the metadata and headers are converted
+    as python objects. The transferred body ArrayBuffer is copied into the
+    wasm heap once, as a memoryview that the servers read without copying.
+    """
+    body = request.body
+    if body is None or not body.byteLength:
+        body = EMPTY_BODY
+    else:
+        body = body.to_memoryview()
+    return {
+        'method': request.method,
+        'scheme': request.scheme,
+        'server': request.server,
+        'port': request.port,
+        'path': request.path,
+        'query': request.query,
+        'headers': request.headers.to_py(),
+        'body': body,
+    }
+
+
+def respond_early(request, sample):
+    """
+    Answers the request without the application: with 304 by a declared
+    validator or from the response cache. Returns the response or None, and
+    the declared ETag for finish_response.
+    """
+    response = etag = None
+    if static_files:
+        response = static_files.respond(request, sample)
+        if response is not None:
+            return response, None
+    if conditional.enabled():
+        response, etag = conditional.check(request)
+    if response is None and response_cache:
+        response = response_cache.lookup(request)
+        if response is not None and conditional.enabled():
+            response = conditional.respond(request, response)
+    if response is not None and sample:
+        sample.route = route_template(request['path'], {})
+    return response, etag
+
+
+def finish_response(request, response, etag):
+    if response_cache:
+        response_cache.store(request, response)
+    if conditional.enabled():
+        response = conditional.respond(request, response, etag)
+    return response
+
+
+def begin_request(request):
+    """
+    Converts the request from js and answers it early when possible(metrics,
+    respond_early). Returns the request, its RequestSample, the early
+    response or None, and the ETag for finish_response.
+    """
+    sample = metrics.start()
+    request = request_to_py(request)
+    if metrics.is_metrics_request(request):
+        return request, None, metrics.response(request), None
+    response, etag = respond_early(request, sample)
+    return request, sample, response, etag
+
+
+def call_wsgi(request, stream, sample):
+    if request_profiler and request_profiler.wants(request):
+        return request_profiler.run(wsgi_server.handle_request, request,
+                                    stream=stream, sample=sample)
+    return wsgi_server.handle_request(request, stream=stream, sample=sample)
+
+
+async def call_wsgi_async(request, sample):
+    if request_profiler and request_profiler.wants(request):
+        return await request_profiler.run_async(wsgi_server.handle_request_async, request,
+                                                sample=sample)
+    return await wsgi_server.handle_request_async(request, sample=sample)
+
+
+def handle_wsgi(request, stream=False):
+    request, sample, response, etag = begin_request(request)
+    if response is None:
+        response = finish_response(request, call_wsgi(request, stream, sample), etag)
+    # body of a stream is a stream id, see next_chunk
+    return metrics.convert(response, sample)
+
+
+async def handle_wsgi_async(request, stream=False):
+    # streams already give way between chunks, each is pulled by js
+    if stream:
+        return handle_wsgi(request, stream)
+    request, sample, response, etag = begin_request(request)
+    if response is None:
+        response = finish_response(request, await call_wsgi_async(request, sample), etag)
+    return metrics.convert(response, sample)
+
+
+async def call_asgi(request, stream, sample):
+    if request_profiler and request_profiler.wants(request):
+        return await request_profiler.run_async(asgi_server.handle_request, request,
+                                                stream=stream, sample=sample)
+    return await asgi_server.handle_request(request, stream=stream, sample=sample)
+
+
+async def handle_asgi(request, stream=False):
+    request, sample, response, etag = begin_request(request)
+    if response is None:
+        if single_flight and not stream:
+            response = await single_flight.run(request, call_asgi, request, stream, sample)
+        else:
+            response = await call_asgi(request, stream, sample)
+        response = finish_response(request, response, etag)
+    # body(AsgiResponseStream) of a stream is not convertible, it goes to js
+    # as an async iterable PyProxy
+    return metrics.convert(response, sample)
+
+
+def internal_error():
+    return convert_response({
+        'status': 500,
+        'headers': {
+            'server': server_version,
+            'content-type': 'text/plain; charset=utf-8',
+        },
+        'body': b'Internal Server Error',
+    })
 
 
 def run_wsgi(request):
-    request = request.to_py()
-    response = wsgi_server.handle_request(request)
-    return to_js(response, dict_converter=Object.fromEntries)
+    response = handle_wsgi(request)
+    log_sink.flush()
+    return response
+
+
+def with_queued(response):
+    """
+    Pairs what goes to js with the number of requests waiting for admission,
+    so that the page learns it without another call(it starts another worker
+    when not 0).
+    """
+    return to_js([response, len(asgi_server.admission.waiters)])
 
 
 async def run_asgi(request):
-    request = request.to_py()
-    response = await asgi_server.handle_request(request)
-    return to_js(response, dict_converter=Object.fromEntries)
+    response = await handle_asgi(request)
+    log_sink.flush()
+    return with_queued(response)
+
+
+def run_wsgi_batch(requests, stream=False):
+    """
+    Handles a batch of requests in one call from js, and returns their
+    responses in order. A failing request gets a 500 response of its own.
+    """
+    responses = []
+    for request in requests:
+        try:
+            responses.append(handle_wsgi(request, stream))
+        except Exception as e:
+            logger.error("Failed to handle request: %s", e)
+            responses.append(internal_error())
+    log_sink.flush()
+    return to_js(responses)
+
+
+async def gather_batch(handle, requests, stream):
+    """
+    Handles a batch of requests concurrently on the event loop, and returns
+    their responses in order. A failing request gets a 500 response of its own.
+    """
+    results = await asyncio.gather(*(handle(request, stream) for request in requests),
+                                   return_exceptions=True)
+    responses = []
+    for result in results:
+        if isinstance(result, BaseException):
+            logger.error("Failed to handle request: %s", result)
+            result = internal_error()
+        responses.append(result)
+    log_sink.flush()
+    return responses
+
+
+async def run_asgi_batch(requests, stream=False):
+    return with_queued(await gather_batch(handle_asgi, requests, stream))
+
+
+async def run_wsgi_async(request):
+    response = await handle_wsgi_async(request)
+    log_sink.flush()
+    return response
+
+
+async def run_wsgi_async_batch(requests, stream=False):
+    return to_js(await gather_batch(handle_wsgi_async, requests, stream))
+
+
+def profiles():
+    """
+    Profiles of the requests kept by the request profiler, oldest first.
+    """
+    history = list(request_profiler.history) if request_profiler else []
+    return to_js(history, dict_converter=Object.fromEntries)
+
+
+def cache_stats():
+    stats = response_cache.stats() if response_cache else {}
+    return to_js(stats, dict_converter=Object.fromEntries)
+
+
+def invalidate_cache(path=None):
+    """
+    Removes the cached responses of the path, or all of them.
+    """
+    if response_cache:
+        response_cache.invalidate(path)
+
+
+def server_stats():
+    stats = asgi_server.admission.stats() if asgi_server else {}
+    if single_flight:
+        stats.update(single_flight.stats())
+    return to_js(stats, dict_converter=Object.fromEntries)
+
+
+def run_wsgi_stream(request):
+    response = handle_wsgi(request, stream=True)
+    log_sink.flush()
+    return response
+
+
+def next_chunk(stream_id):
+    chunk = wsgi_server.next_chunk(stream_id)
+    if chunk is None:
+        return None
+    return to_js(chunk)
+
+
+def close_stream(stream_id):
+    wsgi_server.close_stream(stream_id)
+
+
+async def run_asgi_stream(request):
+    response = await handle_asgi(request, stream=True)
+    log_sink.flush()
+    return with_queued(response)
@@ -4,14 +4,56 @@ import * as Comlink from "comlink";
 let started = false;
 let isWsgi = true;
 let isAsgi = false;
+let isStream = false;
+let isWsgiAsync = false;
 let pyodide;
+let report = null;
 let console = self.console;
 
 const WEBCORN_PY = `
 {WEBCORN.PY}
 `;
 
-const start = async (pyodideUrl, projectRoot, appSpec, appUrl, logger) => {
+// Wrap the body iterator returned by run_asgi_stream into a ReadableStream,
+// chunks are pulled on demand so the python side is throttled by the reader.
+const bodyToStream = (body) => {
+    const iterator = body[Symbol.asyncIterator]();
+    return new ReadableStream({
+        async pull(controller) {
+            const { value, done } = await iterator.next();
+            if (done) {
+                body.destroy();
+                controller.close();
+                return;
+            }
+            controller.enqueue(value.toJs());
+            value.destroy();
+        },
+        async cancel() {
+            await body.aclose();
+            body.destroy();
+        },
+    }, { highWaterMark: 1 });
+}
+
+// Pull the body of a run_wsgi_stream response chunk by chunk
+const handleToStream = (streamId) => {
+    return new ReadableStream({
+        pull(controller) {
+            const chunk = pyodide.globals.get('next_chunk')(streamId);
+            if (chunk === undefined) {
+                controller.close();
+            } else {
+                controller.enqueue(chunk);
+            }
+        },
+        cancel() {
+            pyodide.globals.get('close_stream')(streamId);
+        },
+    }, { highWaterMark: 1 });
+}
+
+const start = async (pyodideUrl, projectRoot, appSpec, appUrl, logger, options = {}) => {
     console = logger;
     let begin = performance.now();
     console.log("Loading pyodide...");
@@ -25,51 +67,151 @@ const start = async (pyodideUrl, projectRoot, appSpec, appUrl, logger) => {
     await pyodide.loadPackage('hashlib');
     await pyodide.loadPackage('micropip');
     await pyodide.runPythonAsync(WEBCORN_PY);
-    await pyodide.globals.get('load_app')(projectRoot, appSpec, appUrl, console);
+    report = await pyodide.globals.get('load_app')(projectRoot, appSpec, appUrl, console, options);
+    report.phases.unshift({name: 'load_pyodide', ms: end - begin});
+    report.total_ms = performance.now() - begin;
     isWsgi = pyodide.globals.get('is_wsgi');
     isAsgi = pyodide.globals.get('is_asgi');
+    isStream = !!options.stream;
+    isWsgiAsync = !!options.wsgi_async;
     started = true;
     return isWsgi;
 }
 
-const handleRequest = async (request) => {
-    const encoder = new TextEncoder();
-    let response = {
+const errorResponse = (message) => {
+    return {
         status: 500,
-        headers: {
+        headers: JSON.stringify({
             'Content-Type': 'text/plain; charset=utf-8',
-        },
-        body: encoder.encode("server not started").buffer,
+        }),
+        body: new TextEncoder().encode(message).buffer,
     };
+}
+
+// Makes a response returned by webcorn.py transferable to the page
+const toTransferable = (response) => {
+    if (ArrayBuffer.isView(response)) {
+        // binary envelope of status, headers and body(see encode_envelope
+        // in webcorn.py), decoded by the page
+        return { envelope: response.buffer };
+    }
+    if (ArrayBuffer.isView(response.body)) {
+        // response.body is TypedArray, which is not transferable object,
+        // response.body.buffer(ArrayBuffer) is.
+        response.body = response.body.buffer;
+    } else if (typeof response.body === 'string') {
+        response.body = handleToStream(response.body);
+    } else {
+        // ReadableStream is transferable
+        response.body = bodyToStream(response.body);
+    }
+
+    // simplify handling of seralization for postMessage
+    response.headers = JSON.stringify(response.headers);
+    return response;
+}
 
+const handleRequest = async (request) => {
     if (!started) {
-        return response;
+        return errorResponse("server not started");
     }
 
-    response.body = encoder.encode("server internal error").buffer;
+    let response = errorResponse("server internal error");
+    // requests waiting for admission, the page starts another worker if not 0
+    let queued = 0;
     try {
-        if (isWsgi) {
+        if (isWsgi && isStream) {
+            response = pyodide.globals.get('run_wsgi_stream')(request);
+        } else if (isWsgi && isWsgiAsync) {
+            response = await pyodide.globals.get('run_wsgi_async')(request);
+        } else if (isWsgi) {
             response = pyodide.globals.get('run_wsgi')(request);
+        } else if (isAsgi && isStream) {
+            [response, queued] = await pyodide.globals.get('run_asgi_stream')(request);
         } else if (isAsgi) {
-            response = await pyodide.globals.get('run_asgi')(request);
+            [response, queued] = await pyodide.globals.get('run_asgi')(request);
         }
-
-        // response.body is TypedArray, which is not transferable object,
-        // response.body.buffer(ArrayBuffer) is.
-        response.body = response.body.buffer;
-
-        // simplify handling of seralization for postMessage
-        response.headers = JSON.stringify(response.headers);
+        response = toTransferable(response);
+        response.queued = queued;
     } catch (e) {
         console.log(e);
     }
-    Comlink.transfer(response, [response.body]);
+    Comlink.transfer(response, [response.envelope || response.body]);
     return response;
 }
 
+// Handles several requests with one call into python(see run_wsgi_batch and
+// run_asgi_batch in webcorn.py), responses are in the order of the requests
+const handleRequestBatch = async (requests) => {
+    let responses;
+    let queued = 0;
+    if (!started) {
+        responses = requests.map(() => errorResponse("server not started"));
+    } else {
+        try {
+            if (isWsgi && isWsgiAsync) {
+                responses = await pyodide.globals.get('run_wsgi_async_batch')(requests, isStream);
+            } else if (isWsgi) {
+                responses = pyodide.globals.get('run_wsgi_batch')(requests, isStream);
+            } else {
+                [responses, queued] = await pyodide.globals.get('run_asgi_batch')(requests, isStream);
+            }
+            responses = responses.map(toTransferable);
+            responses.forEach((response) => { response.queued = queued; });
+        } catch (e) {
+            console.log(e);
+            responses = requests.map(() => errorResponse("server internal error"));
+        }
+    }
+    Comlink.transfer(responses, responses.map((response) => response.envelope || response.body));
+    return responses;
+}
+
+// Startup phases and import time tree, see StartupProfiler in webcorn.py
+const startupReport = () => {
+    return report;
+}
+
+// Admission statistics of the ASGI server: active/queued requests, wait time...
+const stats = () => {
+    if (!started) {
+        return {};
+    }
+    return pyodide.globals.get('server_stats')();
+}
+
+// Summaries of the requests profiled with cProfile, see RequestProfiler in webcorn.py
+const profiles = () => {
+    if (!started) {
+        return [];
+    }
+    return pyodide.globals.get('profiles')();
+}
+
+// Counters of the response cache, see ResponseCache in webcorn.py
+const cacheStats = () => {
+    if (!started) {
+        return {};
+    }
+    return pyodide.globals.get('cache_stats')();
+}
+
+// Removes the cached responses of the path, or all of them without a path
+const invalidateCache = (path) => {
+    if (started) {
+        pyodide.globals.get('invalidate_cache')(path);
+    }
+}
+
 Comlink.expose({
     start,
     isWsgi,
     isAsgi,
     handleRequest,
+    handleRequestBatch,
+    stats,
+    startupReport,
+    profiles,
+    cacheStats,
+    invalidateCache,
 });
\ No newline at end of file
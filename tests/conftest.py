@@ -0,0 +1,28 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# webcorn.py runs inside pyodide, tests/stubs stand in for pyodide, js and
+# micropip so that its pure python parts can be tested with CPython
+sys.path.insert(0, str(Path(__file__).parent / 'stubs'))
+
+import stubbed_webcorn
+
+
+@pytest.fixture
+def webcorn():
+    module = stubbed_webcorn.load()
+    config = dict(module.config)
+    app_root = module.app_root
+    yield module
+    module.config.clear()
+    module.config.update(config)
+    module.app_root = app_root
+
+
+@pytest.fixture
+def micropip():
+    import micropip
+    micropip.installed.clear()
+    return micropip
@@ -0,0 +1,15 @@
+"""Stand-in for pyodide's js module."""
+
+
+class Object:
+    fromEntries = dict
+
+
+class console:
+    @staticmethod
+    def log(message):
+        pass
+
+    @staticmethod
+    def logBatch(records):
+        pass
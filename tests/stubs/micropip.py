@@ -0,0 +1,16 @@
+"""Stand-in for micropip that records what would be installed."""
+import json
+
+installed = []
+
+
+async def install(requirements, deps=True):
+    installed.append((requirements, deps))
+
+
+def list():
+    return {}
+
+
+def freeze():
+    return json.dumps({'packages': {}})
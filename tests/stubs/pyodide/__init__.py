@@ -0,0 +1 @@
+"""Stand-in for the parts of pyodide webcorn.py uses, to run it under CPython."""
@@ -0,0 +1,14 @@
+def to_js(obj, **kwargs):
+    return obj
+
+
+def can_run_sync():
+    return False
+
+
+def run_sync(awaitable):
+    raise RuntimeError("run_sync needs JSPI")
+
+
+def create_once_callable(func):
+    return func
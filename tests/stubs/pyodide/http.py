@@ -0,0 +1,2 @@
+async def pyfetch(url, **kwargs):
+    raise OSError(f'no network to fetch {url}')
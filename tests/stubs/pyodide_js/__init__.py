@@ -0,0 +1 @@
+"""Stand-in for pyodide's pyodide_js module."""
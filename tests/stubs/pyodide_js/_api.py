@@ -0,0 +1,6 @@
+class LockfilePackages:
+    def to_py(self):
+        return {}
+
+
+lockfile_packages = LockfilePackages()
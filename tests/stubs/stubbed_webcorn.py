@@ -0,0 +1,28 @@
+"""
+Loads src/webcorn.py under CPython, with the modules of this directory
+standing in for pyodide, js and micropip.
+"""
+import importlib.util
+import sys
+from pathlib import Path
+
+STUBS = Path(__file__).parent
+SOURCE = STUBS.parent.parent / 'src' / 'webcorn.py'
+
+
+def load(source=SOURCE):
+    """
+    Returns the webcorn module, loaded from source on the first call. bench/
+    passes an older webcorn.py(e.g. git show <commit>:src/webcorn.py) to
+    compare against.
+    """
+    if str(STUBS) not in sys.path:
+        sys.path.insert(0, str(STUBS))
+    if 'webcorn' not in sys.modules:
+        spec = importlib.util.spec_from_file_location('webcorn', source)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['webcorn'] = module
+        spec.loader.exec_module(module)
+        import js
+        module.js_console = js.console
+    return sys.modules['webcorn']
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def controller(webcorn):
+    return webcorn.AdmissionController(max_concurrency=1, max_queue=1, timeout=0.05)
+
+
+def test_admits_up_to_max_concurrency(controller):
+    async def main():
+        assert await controller.acquire()
+        waiting = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        assert controller.stats()['queued'] == 1
+        controller.release()
+        assert await waiting
+        assert controller.active == 1
+        controller.release()
+        assert controller.active == 0
+    asyncio.run(main())
+
+
+def test_rejects_when_queue_is_full(controller):
+    async def main():
+        assert await controller.acquire()
+        waiting = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        assert not await controller.acquire()
+        assert controller.rejected == 1
+        controller.release()
+        assert await waiting
+    asyncio.run(main())
+
+
+def test_times_out_while_waiting(controller):
+    async def main():
+        assert await controller.acquire()
+        assert not await controller.acquire()
+        assert controller.timed_out == 1
+        assert controller.stats()['queued'] == 0
+        controller.release()
+        assert controller.active == 0
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_leaves_the_queue(controller):
+    async def main():
+        assert await controller.acquire()
+        waiting = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert controller.stats()['queued'] == 0
+        controller.release()
+        assert controller.active == 0
+    asyncio.run(main())
+
+
+def test_slot_handed_over_as_the_wait_times_out(controller, monkeypatch):
+    wait_for = asyncio.wait_for
+
+    async def release_then_time_out(future, timeout):
+        # release() and the timeout in the same loop iteration
+        controller.release()
+        raise asyncio.TimeoutError()
+
+    async def main():
+        assert await controller.acquire()
+        monkeypatch.setattr(asyncio, 'wait_for', release_then_time_out)
+        try:
+            assert await controller.acquire()
+        finally:
+            monkeypatch.setattr(asyncio, 'wait_for', wait_for)
+        assert controller.active == 1
+        assert controller.timed_out == 0
+        controller.release()
+        assert controller.active == 0
+    asyncio.run(main())
@@ -0,0 +1,57 @@
+import asyncio
+
+
+def request(path='/'):
+    return {
+        'method': 'GET',
+        'scheme': 'http',
+        'server': 'localhost',
+        'port': '',
+        'path': path,
+        'query': '',
+        'headers': {},
+        'body': b'',
+    }
+
+
+def serve(webcorn, application, **kwargs):
+    webcorn.application = application
+    server = webcorn.AsgiServer(**kwargs)
+    server.startup_event.set()
+    return server
+
+
+async def endless(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+    while True:
+        await send({'type': 'http.response.body', 'body': b'x', 'more_body': True})
+
+
+def test_unread_stream_frees_its_slot(webcorn):
+    async def main():
+        server = serve(webcorn, endless, max_concurrency=1, queue_timeout=1,
+                       stream_idle_timeout=0.05)
+        response = await server.handle_request(request(), stream=True)
+        assert response['status'] == 200
+        # the body is never read, the application blocks on the full queue
+        queued = await server.handle_request(request(), stream=True)
+        assert queued['status'] == 200
+        assert response['body'].closed
+        await queued['body'].aclose()
+        await asyncio.sleep(0.01)
+        assert server.admission.active == 0
+    asyncio.run(main())
+
+
+def test_stream_waiting_for_the_application_is_not_idle(webcorn):
+    async def slow(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await asyncio.sleep(0.15)
+        await send({'type': 'http.response.body', 'body': b'late'})
+
+    async def main():
+        server = serve(webcorn, slow, stream_idle_timeout=0.05)
+        response = await server.handle_request(request(), stream=True)
+        chunks = [chunk async for chunk in response['body']]
+        assert chunks == [b'late']
+    asyncio.run(main())
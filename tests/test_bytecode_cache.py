@@ -0,0 +1,22 @@
+import sys
+from importlib.util import cache_from_source
+
+
+def test_seed_copies_bytecode_of_this_interpreter(webcorn, tmp_path, monkeypatch):
+    root = tmp_path / 'project'
+    pycache = root / 'app' / '__pycache__'
+    pycache.mkdir(parents=True)
+    (root / 'app' / 'views.py').write_text('')
+    tag = sys.implementation.cache_tag
+    for name in (f'views.{tag}.pyc', 'views.cpython-30.pyc', f'views.{tag}.opt-1.pyc',
+                 f'orphan.{tag}.pyc'):
+        (pycache / name).write_bytes(name.encode())
+    prefix = tmp_path / 'pycache'
+    monkeypatch.setattr(sys, 'pycache_prefix', str(prefix))
+
+    webcorn.BytecodeCache(str(prefix)).seed(root)
+
+    target = cache_from_source(str(root / 'app' / 'views.py'))
+    with open(target, 'rb') as f:
+        assert f.read() == f'views.{tag}.pyc'.encode()
+    assert [path.name for path in prefix.rglob('*.pyc')] == [f'views.{tag}.pyc']
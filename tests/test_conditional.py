@@ -0,0 +1,46 @@
+import pytest
+
+
+@pytest.fixture
+def conditional(webcorn):
+    return webcorn.ConditionalResponses()
+
+
+def request(path='/articles/1/', method='GET', **headers):
+    return {'method': method, 'path': path, 'query': '',
+            'headers': {name.replace('_', '-'): value for name, value in headers.items()}}
+
+
+def test_validator_answers_304(conditional):
+    conditional.validator(r'/articles/(?P<pk>\d+)/')(lambda request, match: f'"v{match["pk"]}"')
+    response, etag = conditional.check(request(if_none_match='"v1"'))
+    assert response['status'] == 304
+    assert response['headers']['etag'] == '"v1"'
+    response, etag = conditional.check(request(if_none_match='"v0"'))
+    assert response is None and etag == '"v1"'
+
+
+def test_failing_validator_leaves_request_to_app(conditional):
+    def article_etag(request, match):
+        raise LookupError('DoesNotExist')
+    conditional.validator(r'/articles/(?P<pk>\d+)/')(article_etag)
+    assert conditional.check(request(if_none_match='"v1"')) == (None, None)
+
+
+def test_generated_etag(webcorn, conditional):
+    webcorn.config['etag'] = True
+    response = conditional.respond(request(), {'status': 200, 'headers': {}, 'body': b'body'})
+    etag = response['headers']['etag']
+    assert etag.startswith('W/"')
+    response = conditional.respond(request(if_none_match=etag),
+                                   {'status': 200, 'headers': {}, 'body': b'body'})
+    assert response['status'] == 304
+
+
+def test_no_etag_hashed_for_head(webcorn, conditional):
+    webcorn.config['etag'] = True
+    response = conditional.respond(request(method='HEAD'), {'status': 200, 'headers': {}, 'body': b''})
+    assert 'etag' not in response['headers']
+    response = conditional.respond(request(method='HEAD'), {'status': 200, 'headers': {}, 'body': b''},
+                                   etag='"v1"')
+    assert response['headers']['etag'] == '"v1"'
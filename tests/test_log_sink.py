@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+
+class Console:
+    def __init__(self):
+        self.batches = []
+        self.fail = False
+
+    def logBatch(self, records):
+        if self.fail:
+            raise RuntimeError('page is gone')
+        self.batches.append(records)
+
+
+@pytest.fixture
+def sink(webcorn, monkeypatch):
+    webcorn.config.update(log_batch=3, log_buffer=5, log_flush_ms=60000)
+    monkeypatch.setattr(webcorn, 'js_console', Console())
+    return webcorn.LogSink()
+
+
+def emit(sink, count):
+    async def main():
+        for i in range(count):
+            sink.emit('info', 'test', 'record %d', (i,), None)
+        sink.flush()
+    asyncio.run(main())
+
+
+def messages(batch):
+    return [record['message'] for record in batch]
+
+
+def test_batches(webcorn, sink):
+    emit(sink, 4)
+    assert [messages(batch) for batch in webcorn.js_console.batches] == [
+        ['record 0', 'record 1', 'record 2'], ['record 3']]
+
+
+def test_keeps_records_until_console_is_attached(webcorn, sink, monkeypatch):
+    console = webcorn.js_console
+    monkeypatch.setattr(webcorn, 'js_console', None)
+    emit(sink, 7)
+    assert sink.dropped == 2
+    monkeypatch.setattr(webcorn, 'js_console', console)
+    sink.flush()
+    [batch] = console.batches
+    assert messages(batch) == ['2 log records dropped'] + [f'record {i}' for i in range(2, 7)]
+
+
+def test_keeps_records_while_logbatch_fails(webcorn, sink):
+    console = webcorn.js_console
+    console.fail = True
+    emit(sink, 6)
+    assert len(sink.records) == 5 and sink.dropped == 1
+    console.fail = False
+    sink.flush()
+    [batch] = console.batches
+    assert messages(batch) == ['1 log records dropped'] + [f'record {i}' for i in range(1, 6)]
+    assert not sink.records and not sink.dropped
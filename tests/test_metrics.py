@@ -0,0 +1,13 @@
+def test_metrics_are_opt_in(webcorn):
+    webcorn.app_root = '/srv/~webcorn'
+    assert not webcorn.metrics.is_metrics_request({'path': '/srv/~webcorn/~webcorn/metrics'})
+    assert webcorn.metrics.start() is None
+
+
+def test_metrics_path_is_exact(webcorn):
+    webcorn.config['metrics'] = True
+    webcorn.app_root = '/srv/~webcorn'
+    assert webcorn.metrics.is_metrics_request({'path': '/srv/~webcorn/~webcorn/metrics'})
+    # the app's own /metrics route
+    assert not webcorn.metrics.is_metrics_request({'path': '/srv/~webcorn/metrics'})
+    assert not webcorn.metrics.is_metrics_request({'path': '/srv/~webcorn/api/~webcorn/metrics'})
@@ -0,0 +1,32 @@
+import asyncio
+
+
+def request(headers):
+    return {'method': 'GET', 'path': '/', 'query': '', 'headers': headers}
+
+
+def response():
+    return {'status': 200, 'headers': {}, 'body': b''}
+
+
+def test_one_request_is_profiled_at_a_time(webcorn):
+    profiler = webcorn.RequestProfiler('X-Webcorn-Profile', sample=0, history=10, top=5)
+    profiled = request({'x-webcorn-profile': '1'})
+
+    async def handle(request):
+        # a second profiled request arrives while this one awaits
+        assert not profiler.wants(profiled)
+        await asyncio.sleep(0)
+        return response()
+
+    async def main():
+        assert profiler.wants(profiled)
+        await profiler.run_async(handle, profiled)
+        assert profiler.wants(profiled)
+    asyncio.run(main())
+    assert len(profiler.history) == 1
+
+
+def test_sampling(webcorn):
+    profiler = webcorn.RequestProfiler('x-webcorn-profile', sample=3, history=10, top=5)
+    assert [profiler.wants(request({})) for _ in range(6)] == [False, False, True] * 2
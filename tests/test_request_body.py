@@ -0,0 +1,30 @@
+import io
+
+import pytest
+
+LINES = b'first\nsecond line\n\nno newline at the end'
+
+
+@pytest.mark.parametrize('body', [LINES, bytearray(LINES), memoryview(LINES)])
+def test_readline_matches_bytesio(webcorn, body):
+    assert list(webcorn.RequestBody(body)) == list(io.BytesIO(LINES))
+
+
+@pytest.mark.parametrize('size', [0, 1, 5, 6, 7, 100, -1, None])
+def test_readline_size(webcorn, size):
+    body = webcorn.RequestBody(LINES)
+    expected = io.BytesIO(LINES)
+    for _ in range(6):
+        assert body.readline(size) == expected.readline(size)
+
+
+def test_long_line(webcorn):
+    data = b'x' * (3 * webcorn.RequestBody.CHUNK_SIZE) + b'\ntail'
+    body = webcorn.RequestBody(data)
+    assert body.readline() == data[:-4]
+    assert body.read() == b'tail'
+    assert body.readline() == b''
+
+
+def test_readlines_hint(webcorn):
+    assert webcorn.RequestBody(LINES).readlines(7) == [b'first\n', b'second line\n']
@@ -0,0 +1,108 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def cache(webcorn):
+    return webcorn.ResponseCache(4000)
+
+
+def request(path='/p', query='', method='GET', **headers):
+    return {'method': method, 'path': path, 'query': query,
+            'headers': {name.replace('_', '-'): value for name, value in headers.items()}}
+
+
+def response(body=b'body', status=200, **headers):
+    headers = {name.replace('_', '-'): value for name, value in headers.items()}
+    headers.setdefault('cache-control', 'max-age=60')
+    return {'status': status, 'headers': headers, 'body': body}
+
+
+def test_stores_and_serves_with_age(cache):
+    cache.store(request(), response(age='5'))
+    cached = cache.lookup(request())
+    assert bytes(cached['body']) == b'body'
+    assert cached['headers']['age'] == '5'
+    assert cache.lookup(request(query='other')) is None
+    assert cache.stats()['hits'] == 1
+
+
+@pytest.mark.parametrize('headers', [
+    {'cache-control': 'no-store, max-age=60'},
+    {'cache-control': 'private, max-age=60'},
+    {'cache-control': 'max-age=0'},
+    {'cache-control': 'max-age=60', 'vary': '*'},
+    {'cache-control': 'max-age=60', 'set-cookie': 'a=1'},
+    {},
+])
+def test_uncacheable_responses(cache, headers):
+    cache.store(request(), {'status': 200, 'headers': headers, 'body': b'body'})
+    assert cache.lookup(request()) is None
+
+
+def test_request_no_cache_bypasses(cache):
+    cache.store(request(), response())
+    assert cache.lookup(request(cache_control='no-cache')) is None
+
+
+def test_authorization_is_not_shared(cache):
+    cache.store(request(authorization='Bearer alice'), response(b'alice'))
+    assert cache.lookup(request(authorization='Bearer bob')) is None
+    assert cache.lookup(request()) is None
+
+
+@pytest.mark.parametrize('cache_control', ['public, max-age=60', 's-maxage=60', 'max-age=60, must-revalidate'])
+def test_authorization_with_explicit_sharing(cache, cache_control):
+    cache.store(request(authorization='Bearer alice'), response(cache_control=cache_control))
+    assert cache.lookup(request(authorization='Bearer bob')) is not None
+
+
+def test_vary(cache):
+    cache.store(request(accept_language='en'), response(b'en', vary='Accept-Language'))
+    cache.store(request(accept_language='zh'), response(b'zh', vary='Accept-Language'))
+    assert bytes(cache.lookup(request(accept_language='en'))['body']) == b'en'
+    assert bytes(cache.lookup(request(accept_language='zh'))['body']) == b'zh'
+    assert cache.lookup(request(accept_language='fr')) is None
+    # a new Vary drops the variants of the old one
+    cache.store(request(accept='text/html'), response(b'html', vary='Accept'))
+    assert cache.lookup(request(accept_language='en')) is None
+    assert cache.stats()['entries'] == 1
+
+
+def test_unsafe_request_invalidates_the_path(cache):
+    cache.store(request(), response())
+    cache.store(request(query='page=2'), response())
+    cache.store(request('/other'), response())
+    cache.store(request(method='POST'), {'status': 500, 'headers': {}, 'body': b''})
+    assert cache.stats()['entries'] == 3
+    cache.store(request(method='POST'), {'status': 302, 'headers': {}, 'body': b''})
+    assert cache.lookup(request()) is None
+    assert cache.lookup(request(query='page=2')) is None
+    assert cache.lookup(request('/other')) is not None
+    cache.invalidate()
+    assert cache.stats()['entries'] == 0
+    assert not cache.vary and not cache.paths
+
+
+def test_evicts_least_recently_used_within_capacity(cache):
+    for i in range(5000):
+        cache.store(request(query=f'i={i}'), response(b'x' * 50))
+    assert cache.size <= cache.capacity
+    assert cache.stats()['evictions'] > 0
+    assert len(cache.vary) == len(cache.entries)
+    assert cache.lookup(request(query='i=4999')) is not None
+    assert cache.lookup(request(query='i=0')) is None
+
+
+def test_expired_entries_are_removed(cache, monkeypatch):
+    cache.store(request(), response(cache_control='max-age=10'))
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 11)
+    assert cache.lookup(request()) is None
+    assert not cache.entries and not cache.vary
+
+
+def test_large_responses_are_not_stored(cache):
+    cache.store(request(), response(b'x' * 2000))
+    assert cache.lookup(request()) is None
@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+
+def request(method='GET', path='/p'):
+    return {'method': method, 'path': path, 'query': '', 'headers': {}}
+
+
+def make_app():
+    calls = []
+
+    async def app(name, release):
+        calls.append(name)
+        await release.wait()
+        return {'status': 200, 'headers': {'x-from': name}, 'body': b'body'}
+    return app, calls
+
+
+def test_coalesces_identical_requests(webcorn):
+    async def main():
+        flight = webcorn.SingleFlight([])
+        app, calls = make_app()
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(flight.run(request(), app, name, release))
+                 for name in ('a', 'b', 'c')]
+        await asyncio.sleep(0)
+        release.set()
+        responses = await asyncio.gather(*tasks)
+        assert calls == ['a']
+        assert [r['headers']['x-from'] for r in responses] == ['a', 'a', 'a']
+        assert flight.stats()['coalesced'] == 2
+        assert not flight.inflight
+    asyncio.run(main())
+
+
+def test_other_methods_are_not_coalesced(webcorn):
+    async def main():
+        flight = webcorn.SingleFlight([])
+        app, calls = make_app()
+        release = asyncio.Event()
+        release.set()
+        await asyncio.gather(*(flight.run(request('POST'), app, name, release) for name in 'ab'))
+        assert calls == ['a', 'b']
+    asyncio.run(main())
+
+
+def test_follower_takes_over_from_cancelled_leader(webcorn):
+    async def main():
+        flight = webcorn.SingleFlight([])
+        app, calls = make_app()
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(flight.run(request(), app, name, release))
+                 for name in ('a', 'b', 'c')]
+        await asyncio.sleep(0)
+        tasks[0].cancel()
+        await asyncio.sleep(0.01)
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await tasks[0]
+        responses = await asyncio.gather(*tasks[1:])
+        assert calls == ['a', 'b']
+        assert [r['headers']['x-from'] for r in responses] == ['b', 'b']
+        assert not flight.inflight
+    asyncio.run(main())
+
+
+def test_cancelled_follower_leaves_leader_running(webcorn):
+    async def main():
+        flight = webcorn.SingleFlight([])
+        app, calls = make_app()
+        release = asyncio.Event()
+        leader = asyncio.create_task(flight.run(request(), app, 'a', release))
+        follower = asyncio.create_task(flight.run(request(), app, 'b', release))
+        await asyncio.sleep(0)
+        follower.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert (await leader)['headers']['x-from'] == 'a'
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+        assert calls == ['a']
+    asyncio.run(main())
+
+
+def test_exception_is_shared(webcorn):
+    async def main():
+        flight = webcorn.SingleFlight([])
+
+        async def app():
+            await asyncio.sleep(0)
+            raise ValueError('boom')
+        results = await asyncio.gather(flight.run(request(), app), flight.run(request(), app),
+                                       return_exceptions=True)
+        assert all(isinstance(r, ValueError) for r in results)
+    asyncio.run(main())
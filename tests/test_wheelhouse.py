@@ -0,0 +1,125 @@
+import asyncio
+import io
+import json
+import zipfile
+
+
+def make_wheel(directory, name, version, requires=(), tag='py3-none-any'):
+    path = directory / f'{name}-{version}-{tag}.whl'
+    metadata = ['Metadata-Version: 2.1', f'Name: {name}', f'Version: {version}']
+    metadata += [f'Requires-Dist: {req}' for req in requires]
+    with zipfile.ZipFile(path, 'w') as whl:
+        whl.writestr(f'{name}-{version}.dist-info/METADATA', '\n'.join(metadata) + '\n')
+    return path
+
+
+def load(webcorn, directory):
+    wheelhouse = webcorn.Wheelhouse(directory)
+    asyncio.run(wheelhouse.load())
+    return wheelhouse
+
+
+def test_missing_directory_is_empty(webcorn, tmp_path):
+    wheelhouse = load(webcorn, tmp_path / 'wheelhouse')
+    assert len(wheelhouse) == 0
+    assert wheelhouse.split(['django>=5']) == ([], ['django>=5'])
+    assert wheelhouse.find_pinned('django', '5.0') is None
+
+
+def test_split_follows_dependencies(webcorn, tmp_path):
+    alpha = make_wheel(tmp_path, 'alpha', '1.0', ['beta>=1', 'gamma'])
+    make_wheel(tmp_path, 'beta', '1.0')
+    beta2 = make_wheel(tmp_path, 'beta', '2.0')
+    wheelhouse = load(webcorn, tmp_path)
+    local, remote = wheelhouse.split(['Alpha', 'delta==1.0'])
+    assert local == [f'emfs:{alpha}', f'emfs:{beta2}']
+    assert remote == ['delta==1.0', 'gamma']
+
+
+def test_split_honours_specifiers(webcorn, tmp_path):
+    beta1 = make_wheel(tmp_path, 'beta', '1.0')
+    make_wheel(tmp_path, 'beta', '2.0')
+    wheelhouse = load(webcorn, tmp_path)
+    assert wheelhouse.split(['beta<2']) == ([f'emfs:{beta1}'], [])
+    assert wheelhouse.split(['beta>2']) == ([], ['beta>2'])
+
+
+def test_dependencies_of_extras(webcorn, tmp_path):
+    alpha = make_wheel(tmp_path, 'alpha', '1.0', ['beta', 'gamma; extra == "fast"'])
+    wheelhouse = load(webcorn, tmp_path)
+    assert [req.name for req in wheelhouse.dependencies(alpha, set())] == ['beta']
+    assert [req.name for req in wheelhouse.dependencies(alpha, {'fast'})] == ['beta', 'gamma']
+
+
+def test_unsupported_tags_are_skipped(webcorn, tmp_path):
+    make_wheel(tmp_path, 'alpha', '1.0', tag='cp27-cp27m-win32')
+    (tmp_path / 'not-a-wheel.whl').write_bytes(b'')
+    wheelhouse = load(webcorn, tmp_path)
+    assert len(wheelhouse) == 0
+
+
+def test_locked_requirements(webcorn, tmp_path):
+    alpha = make_wheel(tmp_path, 'alpha', '1.0')
+    wheelhouse = load(webcorn, tmp_path)
+    lock = {'packages': [
+        {'name': 'alpha', 'version': '1.0', 'file_name': 'https://example.com/alpha-1.0-py3-none-any.whl'},
+        {'name': 'beta', 'version': '2.0', 'file_name': 'https://example.com/beta-2.0-py3-none-any.whl'},
+        {'name': 'regex', 'version': '2024.9.11', 'file_name': 'regex-2024.9.11-cp312-cp312-pyodide_2024_0_wasm32.whl'},
+    ]}
+    assert webcorn.locked_requirements(lock, wheelhouse) == [
+        f'emfs:{alpha}',
+        'https://example.com/beta-2.0-py3-none-any.whl',
+        'regex==2024.9.11',
+    ]
+
+
+def test_install_dependencies_from_wheelhouse(webcorn, micropip, tmp_path):
+    (tmp_path / 'requirements.txt').write_text('alpha\n# comment\ngamma\n')
+    wheelhouse = tmp_path / 'wheelhouse'
+    wheelhouse.mkdir()
+    alpha = make_wheel(wheelhouse, 'alpha', '1.0', ['beta'])
+    beta = make_wheel(wheelhouse, 'beta', '1.0')
+    returned = asyncio.run(webcorn.install_dependencies(tmp_path))
+    assert micropip.installed == [
+        ([f'emfs:{alpha}', f'emfs:{beta}'], False),
+        (['gamma'], True),
+    ]
+    lock = json.loads((tmp_path / webcorn.LOCK_FILE).read_text())
+    assert lock['requirements'] == ['alpha', 'gamma']
+    assert returned == lock
+
+
+class Response:
+    def __init__(self, status, content=b''):
+        self.status = status
+        self.ok = status == 200
+        self.content = content
+
+    async def unpack_archive(self, extract_dir, format):
+        assert format == 'zip'
+        with zipfile.ZipFile(io.BytesIO(self.content)) as archive:
+            archive.extractall(extract_dir)
+
+
+def test_fetch_wheel_bundle(webcorn, tmp_path, monkeypatch):
+    make_wheel(tmp_path, 'alpha', '1.0')
+    bundle = io.BytesIO()
+    with zipfile.ZipFile(bundle, 'w') as archive:
+        archive.write(tmp_path / 'alpha-1.0-py3-none-any.whl', 'alpha-1.0-py3-none-any.whl')
+    fetched = []
+
+    async def pyfetch(url):
+        fetched.append(url)
+        if url.endswith('/project-wheels.zip'):
+            return Response(200, bundle.getvalue())
+        return Response(404)
+
+    monkeypatch.setattr(webcorn, 'pyfetch', pyfetch)
+    directory = tmp_path / 'project' / 'wheelhouse'
+    asyncio.run(webcorn.fetch_wheel_bundle('https://example.com/app/project-wheels.zip', directory))
+    asyncio.run(webcorn.fetch_wheel_bundle('https://example.com/app/other-wheels.zip', tmp_path / 'other'))
+    assert fetched == ['https://example.com/app/project-wheels.zip',
+                       'https://example.com/app/other-wheels.zip']
+    assert not (tmp_path / 'other').exists()
+    wheelhouse = load(webcorn, directory)
+    assert wheelhouse.split(['alpha'])[0] == [f'emfs:{directory / "alpha-1.0-py3-none-any.whl"}']